@@ -0,0 +1,95 @@
+""" Micro-benchmark des expressions régulières du chemin critique de l'analyse
+
+    Compare le coût par fichier des motifs reconstruits à chaque appel (ancienne version)
+    et des motifs compilés une seule fois dans PatternSet, sur une liste de 50 000 noms de fichiers.
+
+    Usage : python bench/bench_patterns.py [nombre_de_fichiers]
+"""
+import os
+import re
+import sys
+import random
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import botools
+from botools import PatternSet, split_filepath
+
+AUDIO_SIGNATURE = r'([^#]+)#(\d{1,4})#(\d{1,4})#?(.*)\.(mp3)$'
+ACTION_LINES = [[r'(création du fichier).*"(.*)"'], [r'(mise à jour du fichier).*"(.*)"'],
+                [r'(déplacement du fichier)(?!.*corbeille)', '(.*)', '(vers)', r'(")(.*)"']]
+ARTISTS = ['Solenoide', 'Jazz à Gogo', 'Les Matinales', 'Rock Around', 'Chroniques', 'Radio Ballade Info']
+REPEAT = 3
+
+
+def make_settings():
+    root = {'local': 'D:/Antenne/Enregistrement des emissions/', 'distant': 'L:/Enregistrement des emissions/'}
+    return SimpleNamespace(audioSignature=AUDIO_SIGNATURE, root=root, syncActionLine=ACTION_LINES)
+
+
+def make_files(count):
+    rnd = random.Random(811)
+    files = []
+    for i in range(count):
+        year = rnd.randint(2005, 2024)
+        track = rnd.randint(1, 52)
+        name = f'{rnd.choice(ARTISTS)}#{year}#{track:02d}#Episode {i}.mp3'
+        path = f'D:/Antenne/Enregistrement des emissions/{year}/{track:02d}/'
+        line = f'2024-01-01 10:00:00 Info : Création du fichier "{path}{name}"'
+        title = f'C#-{year}-{track:02d}-({rnd.randint(0, 120)}:{rnd.randint(0, 59):02d})-Episode {i}'
+        values = [title[title.index('('):title.index(')') + 1], str(year), 'current', 'C#', f'{track:02d}']
+        files.append((path + name, name, line, title, values))
+    return files
+
+
+def legacy_cost(settings, files):
+    """ motifs reconstruits à chaque fichier, comme avant PatternSet """
+    for full_pathname, filename, line, title, values in files:
+        re.search(settings.syncActionLine[0][0], line, re.I)
+        path = full_pathname.rsplit('/', maxsplit=1)[0] + '/'
+        find = '(' + '|'.join(settings.root[x] for x in settings.root) + r')(.*)'
+        re.search(find, path, re.I)
+        re.compile(settings.audioSignature, re.I).findall(filename)
+        for value in values:
+            title = re.sub(r'\s?' + value + r'\s?-?', '', title, flags=re.I)
+
+
+def compiled_cost(settings, files):
+    """ motifs compilés une seule fois """
+    patterns = settings.patterns
+    for full_pathname, filename, line, title, values in files:
+        patterns.action_lines[0][0].search(line)
+        split_filepath(full_pathname)
+        patterns.audio.findall(filename)
+        for value in values:
+            title = patterns.title_part(value).sub('', title)
+
+
+def measure(func, settings, files):
+    best = None
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        func(settings, files)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    settings = make_settings()
+    settings.patterns = PatternSet(settings)
+    botools.settings = settings
+    files = make_files(count)
+
+    legacy = measure(legacy_cost, settings, files)
+    compiled = measure(compiled_cost, settings, files)
+    print(f'{count} fichiers, meilleur de {REPEAT} passes')
+    print(f'Motifs reconstruits : {legacy:8.3f} s  {legacy / count * 1e6:8.2f} µs/fichier')
+    print(f'Motifs compilés     : {compiled:8.3f} s  {compiled / count * 1e6:8.2f} µs/fichier')
+    print(f'Gain                : x{legacy / compiled:.2f}')
+
+
+if __name__ == '__main__':
+    main()
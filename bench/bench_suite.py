@@ -0,0 +1,244 @@
+""" Banc de mesure de bout en bout sur une archive synthétique
+
+    Génère dans un répertoire temporaire une archive de petits fichiers mp3 valides (tags ID3, quelques trames MPEG)
+    sous deux racines local et distant, une liste d'émissions avec alias et un log de synchronisation
+    au format FreeFileSync, avec une part réglable de fichiers mal tagués et mal nommés.
+    Mesure ensuite DirScan, FileScan, Engine.manageAudioSet (correction puis vérification) et manage_cp
+    pour chaque taille d'archive et écrit les résultats en JSON pour comparer deux versions sur une même machine.
+
+    Usage : python bench/bench_suite.py [-n 1000 10000 100000] [-o resultats.json] [--mistagged 0.1] [--misnamed 0.05] [--keep]
+"""
+import os
+import sys
+import json
+import random
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import botools
+from botools import Engine, DirScan, FileScan, AudioFile, PatternSet, CP_SLOTS_MARKER, normalize_name
+
+AUDIO_SIGNATURE = r'([^#]+)#(\d{1,4})#(\d{1,4})#?(.*)'
+ACTION_LINES = [[r'(création du fichier).*"(.*)"'], [r'(mise à jour du fichier).*"(.*)"'],
+                [r'(déplacement du fichier)(?!.*corbeille)', '(.*)', '(vers)', r'(")(.*)"']]
+EXCLUDED_PATHS = ['a venir', '@', 'copie', 'exterieur']
+PROGRAMME_NAMES = ['Solenoide', 'Jazz à Gogo', 'Les Matinales', 'Rock Around', 'Chroniques', 'Radio Ballade Info',
+                   'Le Grenier', 'Sur les Ondes', 'Musiques du Monde', 'Ciné Club', 'La Bande à Léon', 'Écoute Voir']
+PROGRAMME_COUNT = 40
+# 4 trames MPEG1 layer III, 128 kbit/s, 44,1 kHz, sans remplissage
+MPEG_FRAME = b'\xff\xfb\x90\x40' + bytes(413)
+MPEG_FRAMES = 4
+LENGTH = botools.format_lasting(8 * len(MPEG_FRAME) * MPEG_FRAMES / 128000)
+ID3_PADDING = 256
+
+
+def make_programmes(rnd):
+    """ liste des émissions : (nom, current/previous, nombre d'emplacements, alias) """
+    programmes = []
+    for i in range(PROGRAMME_COUNT):
+        name = PROGRAMME_NAMES[i % len(PROGRAMME_NAMES)] + ('' if i < len(PROGRAMME_NAMES) else f' {i}')
+        aliases = [name.replace(' ', '') + 'Old', 'Ex ' + name]
+        programmes.append((name, rnd.random() < 0.5, rnd.choice([2, 2, 2, 3, 5]), aliases))
+    return programmes
+
+
+def write_programmes(path, programmes):
+    with open(path, 'w', encoding='utf-8') as target:
+        target.write('# nomprog,currentStatus,nbSlots=N,Alias1,Alias2...\n')
+        for name, status, slots, aliases in programmes:
+            target.write(','.join([name, '1' if status else '0', CP_SLOTS_MARKER + str(slots)] + aliases) + '\n')
+
+
+def load_programmes(programmes):
+    """ équivalent de botag.load_radioprograms sans passer par les paramètres de botag """
+    prog_dict = {}
+    for name, status, slots, aliases in programmes:
+        prog_dict[normalize_name(name)] = (name, status, slots)
+        for alias in aliases:
+            prog_dict.setdefault(normalize_name(alias), (name, status, slots))
+    return prog_dict
+
+
+def id3_frame(frame_id, text):
+    data = b'\x03' + text.encode('utf-8')
+    size = len(data)
+    return frame_id.encode('latin-1') + bytes([(size >> 21) & 0x7f, (size >> 14) & 0x7f, (size >> 7) & 0x7f, size & 0x7f]) \
+        + b'\x00\x00' + data
+
+
+def make_mp3(artist, year, track, title):
+    """ fichier mp3 minimal : tag ID3v2.4 avec un peu de remplissage puis quelques trames MPEG """
+    frames = b''.join([id3_frame('TPE1', artist), id3_frame('TIT2', title), id3_frame('TRCK', str(track)),
+                       id3_frame('TDRC', str(year))]) + bytes(ID3_PADDING)
+    size = len(frames)
+    header = b'ID3\x04\x00\x00' + bytes([(size >> 21) & 0x7f, (size >> 14) & 0x7f, (size >> 7) & 0x7f, size & 0x7f])
+    return header + frames + MPEG_FRAME * MPEG_FRAMES
+
+
+def make_archive(workspace, count, mistagged, misnamed, rnd):
+    """ crée l'archive, la liste des émissions et le log de synchronisation, retourne les paramètres """
+    roots = {root: os.path.join(workspace, root) + '/' for root in ['local', 'distant']}
+    for root in roots.values():
+        os.makedirs(root + 'current')
+    for directory in ['logs', 'sync']:
+        os.makedirs(os.path.join(workspace, directory))
+    programmes = make_programmes(rnd)
+    write_programmes(os.path.join(workspace, 'emissions_radio.txt'), programmes)
+
+    log_lines = []
+    for i in range(count):
+        name, status, slots, aliases = rnd.choice(programmes)
+        year = rnd.randint(2010, 2024)
+        track = rnd.randint(1, 52)
+        raw_title = f'Episode {i}'
+        artist = rnd.choice(aliases) if rnd.random() < misnamed else name
+        relpath = f'{year}/{name}/'
+        filename = f'{artist}#{year}#{track:02d}#{raw_title}.mp3'
+        title = f'{year}-{track:02d}-({LENGTH})-{raw_title}'
+        if rnd.random() < mistagged:
+            title = f'{raw_title} (ancien titre)'
+        data = make_mp3(name, year, track, title)
+        for root in roots.values():
+            os.makedirs(root + relpath, exist_ok=True)
+            with open(root + relpath + filename, 'wb') as target:
+                target.write(data)
+        stamp = f'[{i // 3600 % 24:02d}:{i // 60 % 60:02d}:{i % 60:02d}]'
+        full_pathname = roots['local'] + relpath + filename
+        draw = rnd.random()
+        if draw < 0.05:
+            log_lines += [f'{stamp} Info: Déplacement du fichier', f'"{roots["local"]}a trier/{filename}"', 'vers',
+                          f'"{full_pathname}"']
+        elif draw < 0.15:
+            log_lines.append(f'{stamp} Info: Mise à jour du fichier "{full_pathname}"')
+        else:
+            log_lines.append(f'{stamp} Info: Création du fichier "{full_pathname}"')
+        if rnd.random() < 0.2:
+            log_lines.append(f'{stamp} Info: Création du dossier "{roots["local"]}{relpath}"')
+    sync_log = os.path.join(workspace, 'sync', f'rb_audio {datetime.now():%Y-%m-%d %H%M%S}.log')
+    with open(sync_log, 'w', encoding='utf-8') as target:
+        target.write('\n'.join(log_lines) + '\n')
+
+    settings = SimpleNamespace(
+        noAction=False, makeDistCopy=True, distPropagation='retag', autoCorrectFilename=False,
+        excludedPaths=EXCLUDED_PATHS, testEnv=False, changeLimit=0, timeBudget=0, runJournal='', cpPlanner=True, distAsync=False, distInFlight=256, workers=1,
+        syncPath=os.path.join(workspace, 'sync') + '/', syncSignature=r'rb_audio.+\.log', syncActionLine=ACTION_LINES,
+        syncCursor='', scanDirectory=True, scanAudioFilter=[''], scanPathFilter=[''], scanIndex='', scanPruneDirs=False,
+        scanStream=False, streamWindow=200,
+        allowedExtensions=['mp3'], root=roots, currentPath='current/', audioSignature=AUDIO_SIGNATURE + r'\.(mp3)$',
+        fastTagRead=True, tagPadding=16384, dirCache=True,
+        ioOnAirHours=[''], ioOnAirRate=0, ioOnAirOps=0, ioOffAirRate=0, ioOffAirOps=0, logScreenLevel=-1, logFileLevel=3, logMetrics=False, metricsPath='',
+        logPath=os.path.join(workspace, 'logs') + '/', logMask='RB-bench', logRotation=False, logLimit=30)
+    settings.patterns = PatternSet(settings)
+    return settings, programmes, sync_log
+
+
+def timed_manage_cp(timing):
+    """ remplace temporairement AudioFile.manage_cp pour cumuler sa durée """
+    manage_cp = AudioFile.manage_cp
+
+    def wrapper(audio):
+        start = time.perf_counter()
+        try:
+            return manage_cp(audio)
+        finally:
+            timing['calls'] += 1
+            timing['seconds'] += time.perf_counter() - start
+    return manage_cp, wrapper
+
+
+def manage_files(bot, files):
+    """ boucle principale de botag.py en mode séquentiel """
+    start = time.perf_counter()
+    for file_id in bot.plan_cp(files):
+        bot.manageAudioSet(file_id)
+    return time.perf_counter() - start
+
+
+def run(count, mistagged, misnamed, keep):
+    rnd = random.Random(811 + count)
+    workspace = tempfile.mkdtemp(prefix='botag_bench_')
+    result = {'files': count}
+    try:
+        start = time.perf_counter()
+        settings, programmes, sync_log = make_archive(workspace, count, mistagged, misnamed, rnd)
+        result['generate_s'] = time.perf_counter() - start
+
+        bot = Engine(settings.logScreenLevel, settings.logFileLevel)
+        bot.start(settings)
+        bot.RBProgs = load_programmes(programmes)
+
+        start = time.perf_counter()
+        with DirScan() as files:
+            result['dirscan_s'] = time.perf_counter() - start
+            result['dirscan_selected'] = len(files)
+        start = time.perf_counter()
+        with FileScan(sync_log) as log_files:
+            result['filescan_s'] = time.perf_counter() - start
+            result['filescan_selected'] = len(log_files)
+
+        timing = {'calls': 0, 'seconds': 0.0}
+        manage_cp, AudioFile.manage_cp = timed_manage_cp(timing)
+        try:
+            result['manage_fix_s'] = manage_files(bot, files)
+            result['manage_cp_calls'] = timing['calls']
+            result['manage_cp_s'] = timing['seconds']
+            result['changes'] = bot.change_count
+            bot.cp_index.clear()
+            result['manage_verify_s'] = manage_files(bot, files)
+        finally:
+            AudioFile.manage_cp = manage_cp
+        result['manage_fix_ms_per_file'] = result['manage_fix_s'] / max(len(files), 1) * 1000
+        result['manage_verify_ms_per_file'] = result['manage_verify_s'] / max(len(files), 1) * 1000
+        result['errors'] = bot.count_error
+        result['warnings'] = bot.count_attention
+        bot.close()
+    finally:
+        if keep:
+            result['workspace'] = workspace
+        else:
+            shutil.rmtree(workspace, ignore_errors=True)
+    return result
+
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Banc de mesure de bout en bout de botag sur une archive synthétique")
+    parser.add_argument('-n', '--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help="nombres de fichiers de l'archive, une mesure par taille")
+    parser.add_argument('-o', '--output', default='bench_suite.json', help="fichier JSON des résultats")
+    parser.add_argument('--mistagged', type=float, default=0.1, help="part des fichiers mal tagués")
+    parser.add_argument('--misnamed', type=float, default=0.05, help="part des fichiers nommés avec un alias")
+    parser.add_argument('--keep', action='store_true', help="conserve les archives générées")
+    args = parser.parse_args()
+
+    report = {'date': datetime.now().isoformat(timespec='seconds'), 'version': git_version(),
+              'python': platform.python_version(), 'platform': platform.platform(),
+              'mistagged': args.mistagged, 'misnamed': args.misnamed, 'results': []}
+    for count in args.sizes:
+        result = run(count, args.mistagged, args.misnamed, args.keep)
+        report['results'].append(result)
+        print(f"{count:7d} fichiers : DirScan {result['dirscan_s']:7.3f} s  FileScan {result['filescan_s']:7.3f} s  "
+              f"correction {result['manage_fix_ms_per_file']:6.2f} ms/fichier  "
+              f"vérification {result['manage_verify_ms_per_file']:6.2f} ms/fichier  "
+              f"manage_cp {result['manage_cp_s']:7.3f} s ({result['manage_cp_calls']} appels)")
+    with open(args.output, 'w', encoding='utf-8') as target:
+        json.dump(report, target, indent=1)
+    print(f'Résultats enregistrés dans {args.output}')
+
+
+if __name__ == '__main__':
+    main()
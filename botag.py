@@ -1,6 +1,6 @@
 import os
 import re
-from botools import Engine, normalize_name, get_error_message, format_to_unixpath, BTException, STARS
+from botools import Engine, PatternSet, DEFAULT_CP_SLOTS, CP_SLOTS_MARKER, normalize_name, get_error_message, format_to_unixpath, BTException, STARS
 import configparser
 import keyboard
 import argparse
@@ -13,6 +13,7 @@ SCANFILE = 'SCANFILE'
 SCANDIR = 'SCANDIR'
 AUDIO = 'AUDIO'
 LOGS = 'LOGS'
+IO = 'IO'
 SET_STR = 'str'
 SET_PATH = 'path'
 SET_BOOL = 'bool'
@@ -49,6 +50,8 @@ class Settings(configparser.ConfigParser):
                 helptxt="(True/False) : si True, exécute le programme sans effectuer aucun changement"),
         'makeDistCopy' :  Setting(GENERAL, SET_BOOL,BOTH, shortcmd='-md', default=True, 
                 helptxt="(True/False) : si True, effectue aussi les modifications sur les fichiers distants"),
+        'distPropagation' : Setting(GENERAL, SET_STR, BOTH, shortcmd='-dp', default='retag',
+                helptxt="(retag/copy/patch) : report des tags vers les fichiers distants, retag : tags réécrits, copy : copie du fichier local, patch : seul le bloc des tags est recopié"),
         'autoCorrectFilename' :  Setting(GENERAL, SET_BOOL,BOTH, shortcmd='-ac', default=False, 
                 helptxt="(True/False) : si True, corrige le nom des fichiers si erreur de nommage"),
         'excludedPaths' : Setting(GENERAL, SET_PATH,INI_ONLY, multi=True),
@@ -56,22 +59,49 @@ class Settings(configparser.ConfigParser):
                 helptxt="(True/False) si True, exécution en mode test, l'emplacement des différents chemins est modifié"),
         'changeLimit' : Setting(GENERAL, SET_INT,BOTH, shortcmd='-cl', default=0, 
                 helptxt="Limite ne nombre de fichiers audio pouvant être modifié, 0=aucune limite"),
+        'timeBudget' : Setting(GENERAL, SET_INT, BOTH, shortcmd='-tb', default=0,
+                helptxt="Durée maximale du traitement en secondes, les fichiers les plus récents sont traités en premier, 0=aucune limite"),
+        'runJournal' : Setting(GENERAL, SET_PATH, BOTH, shortcmd='-rj', default='',
+                helptxt="Journal de reprise : un traitement interrompu reprend au fichier suivant sans nouvelle analyse, vide : pas de journal"),
+        'cpPlanner' : Setting(GENERAL, SET_BOOL, INI_ONLY, default=True),
+        'distAsync' : Setting(GENERAL, SET_BOOL, BOTH, shortcmd='-da', default=False,
+                helptxt="(True/False) : si True, les opérations sur les fichiers distants sont faites en arrière-plan pendant le traitement local"),
+        'distInFlight' : Setting(GENERAL, SET_INT, INI_ONLY, default=256),
+        'workers' : Setting(GENERAL, SET_INT, BOTH, shortcmd='-w', default=1,
+                helptxt="Nombre de fichiers audio traités simultanément, les fichiers d'un même artiste restent traités un par un"),
         'syncPath' : Setting(SCANFILE, SET_PATH,BOTH, shortcmd='-sp', default='', 
                 helptxt="Emplacement du fichier ou du répertoire contenant les logs à analyser"),
         'syncSignature' : Setting(SCANFILE, SET_PATH, BOTH, shortcmd='-sp', default='', 
                 helptxt="Expression régulière signature permettant d'identifier les fichiers log"),
         'syncActionLine' : Setting(SCANFILE, SET_PATH, INI_ONLY, multi=2),
+        'syncCursor' : Setting(SCANFILE, SET_PATH, BOTH, shortcmd='-sc', default='',
+                helptxt="Fichier mémorisant la position de lecture de chaque log, vide : seul le dernier log est lu"),
         'scanDirectory' : Setting(SCANDIR, SET_BOOL, BOTH, shortcmd='-sd', default=True, 
                 helptxt="(True/False) si True, le répertoire racine va être parcouru pour vérifier les fichiers audio"),
         'scanAudioFilter' : Setting(SCANDIR, SET_PATH, BOTH, shortcmd='-af', default='', multi=1,
                 helptxt="Filtre les fichiers audio sur leur nome, plusieurs valeurs possible"),
         'scanPathFilter' : Setting(SCANDIR, SET_PATH, BOTH, shortcmd='-pf', default='', multi=1,
                 helptxt="Filtre les fichiers audio sur leur emplacement, plusieurs valeurs possible"),
+        'scanIndex' : Setting(SCANDIR, SET_PATH, BOTH, shortcmd='-si', default='',
+                helptxt="Fichier index des fichiers audio déjà vérifiés, vide : pas d'index, tous les fichiers sont analysés"),
+        'scanStream' : Setting(SCANDIR, SET_BOOL, BOTH, shortcmd='-ss', default=False,
+                helptxt="(True/False) si True, les fichiers sont traités pendant le parcours du répertoire, sans attendre la fin de l'analyse"),
+        'streamWindow' : Setting(SCANDIR, SET_INT, INI_ONLY, default=200),
+        'scanPruneDirs' : Setting(SCANDIR, SET_BOOL, BOTH, shortcmd='-pd', default=False,
+                helptxt="(True/False) si True, les répertoires exclus ou inchangés depuis la dernière analyse complète ne sont pas parcourus"),
         'allowedExtensions' : Setting(SCANDIR, SET_STR, INI_ONLY, shortcmd='-sd', default='mp3', multi="1") ,
         'localRoot' : Setting(AUDIO, SET_PATH, INI_ONLY),
         'distRoot' : Setting(AUDIO, SET_PATH, INI_ONLY),
         'currentPath' : Setting(AUDIO, SET_PATH, INI_ONLY, default='current\\'),
         'audioSignature' : Setting(AUDIO, SET_STR, INI_ONLY),
+        'fastTagRead' : Setting(AUDIO, SET_BOOL, INI_ONLY, default=True),
+        'tagPadding' : Setting(AUDIO, SET_INT, INI_ONLY, default=16384),
+        'dirCache' : Setting(AUDIO, SET_BOOL, INI_ONLY, default=False),
+        'ioOnAirHours' : Setting(IO, SET_STR, INI_ONLY, default='', multi=1),
+        'ioOnAirRate' : Setting(IO, SET_INT, INI_ONLY, default=0),
+        'ioOnAirOps' : Setting(IO, SET_INT, INI_ONLY, default=0),
+        'ioOffAirRate' : Setting(IO, SET_INT, INI_ONLY, default=0),
+        'ioOffAirOps' : Setting(IO, SET_INT, INI_ONLY, default=0),
         'logScreenLevel' : Setting(LOGS, SET_INT, BOTH, shortcmd='-sl', default=2,
                 helptxt="Filtre des messages à l'écran - 0:erreur 1:warning 2:info 3:détaillé 4:complet  -1 : rien du tout"),
         'logFileLevel' : Setting(LOGS, SET_INT, BOTH, shortcmd='-fl', default=3, 
@@ -81,6 +111,10 @@ class Settings(configparser.ConfigParser):
         'logMask' : Setting(LOGS, SET_STR, INI_ONLY, default='TaggerID3Audio'),
         'logRotation' : Setting(LOGS, SET_BOOL, INI_ONLY, default=True),
         'logLimit' : Setting(LOGS, SET_INT, INI_ONLY, default=30),
+        'logMetrics' : Setting(LOGS, SET_BOOL, BOTH, shortcmd='-me', default=False,
+                helptxt="(True/False) si True, mesure la durée des étapes du traitement, résumé en fin de log et fichier JSON à côté du log"),
+        'metricsPath' : Setting(LOGS, SET_PATH, BOTH, shortcmd='-mp', default='',
+                helptxt="Fichier des métriques du traitement au format Prometheus (collecteur textfile), vide : pas d'export"),
     }
     
     def __init__(self):
@@ -190,13 +224,18 @@ class Settings(configparser.ConfigParser):
             self.root = {'local' : "C:/Users/yves/Python Sources/RB/SyncA/", 'distant' : "C:/Users/yves/Python Sources/RB/SyncB/"}
             self.progFileTxt = "C:/Users/yves/Python Sources/RB/source/emissions_radio.txt"
 
+        # expressions régulières compilées une fois pour toutes
+        self.patterns = PatternSet(self)
+
  
 def load_radioprograms():
 
     # chaque émissions à une ligne dans le fichier
-    # ligne : nomprog, currentStauts, Alias1, Alias2....
+    # ligne : nomprog, currentStauts, (nbSlots=N), Alias1, Alias2....
     #   nomProg : nom de l'émission
     #   currentStatus : génération fichier current/previous (0: non   1: Oui)
+    #   nbSlots=N : optionnel, nombre N d'épisodes conservés (current, previous, previous2...), 2 par défaut
+    #               le préfixe nbSlots= évite de confondre un alias numérique avec le nombre d'épisodes
     #   un ou plusieurs alias
 
     # les noms d'artistes/alias sont normalisés (uniquement alphanum en minuscule et sans accent) pour servir d'index
@@ -213,17 +252,26 @@ def load_radioprograms():
                 if not line.startswith('#') and len(elements) > 1 :
                     nom_programme = elements[0]
                     current_status = int(elements[1])==1 # make boolean from 0/1 values
+                    first_alias = 2
+                    slots = DEFAULT_CP_SLOTS
+                    if len(elements) > 2 and elements[2].strip().startswith(CP_SLOTS_MARKER):
+                        slots_value = elements[2].strip()[len(CP_SLOTS_MARKER):]
+                        if slots_value.isdigit():
+                            slots = max(int(slots_value), 1)
+                        else:
+                            bot.warning(f"Nombre d'épisodes invalide pour {nom_programme} : {elements[2].strip()}, {slots} retenus")
+                        first_alias = 3
 
                     # entre le nom en minuscules uniquement alphanum sans accent comme entrée dans le dictionnaire
-                    prog_dict[normalize_name(nom_programme)]=(nom_programme, current_status)
-                    bot.verbose(f"Entrée nom/défaut émission RB : {normalize_name(nom_programme)} => {nom_programme}, {str(current_status)}")
+                    prog_dict[normalize_name(nom_programme)]=(nom_programme, current_status, slots)
+                    bot.verbose(lambda: f"Entrée nom/défaut émission RB : {normalize_name(nom_programme)} => {nom_programme}, {str(current_status)}, {slots}")
                     # entre les alias si ils existent
-                    for i in range(2, len(elements)):
+                    for i in range(first_alias, len(elements)):
                         new_index = normalize_name(elements[i])
                         # don't overwrite existing values
                         if new_index not in prog_dict:
-                            prog_dict[new_index] = (nom_programme, current_status)
-                            bot.verbose(f"Entrée      alias émission  : {normalize_name(nom_programme)} => {nom_programme}, {str(current_status)}")
+                            prog_dict[new_index] = (nom_programme, current_status, slots)
+                            bot.verbose(lambda: f"Entrée      alias émission  : {normalize_name(nom_programme)} => {nom_programme}, {str(current_status)}")
             bot.detail()
     except OSError as e:
         bot.error(f"Lecture impossible du fichier des émissions radio : {settings.progFileTxt}")
@@ -235,6 +283,26 @@ def load_radioprograms():
     else:
         return prog_dict
 
+def process_files(files):
+    """ traite un lot de fichiers, retourne False si la limite de changements ou le temps alloué est atteint """
+    if settings.cpPlanner:
+        files = bot.plan_cp(files)
+    if settings.timeBudget > 0:
+        files = bot.prioritize(files)
+    files = bot.register(files)
+
+    if settings.workers > 1:
+        return bot.manageAudioBatch(files, settings.workers)
+    for position, fileID in enumerate(files):
+        if not bot.budget_allows(fileID):
+            bot.defer(files[position:])
+            return False
+        bot.info()
+        bot.manageAudioSet(fileID)
+        if bot.change_count >= settings.changeLimit and settings.changeLimit > 0:
+            return False
+    return True
+
 # MAIN PROGRAM
 
 try:
@@ -259,25 +327,43 @@ with  bot:
     
     with bot.scan() as files:
         bot.info()
-        if files:
+        if settings.scanDirectory and settings.scanStream:
             bot.info(STARS)
-            bot.info(f"Traitement des actions pour {str(len(files))} fichier(s)")
+            bot.info("Traitement des fichiers au fur et à mesure du parcours du répertoire")
             bot.detail(STARS)
-            
-            for fileID in files:
-                bot.info()
-                bot.manageAudioSet(fileID)
-                if bot.change_count >= settings.changeLimit and settings.changeLimit > 0:
-                    bot.info('Le nombre de changements effectués a atteint la limite , relancer pour continuer')
+            count = bot.manageAudioStream(files)
+            if count is None:
+                bot.info(bot.stop_reason())
+            elif not count:
+                bot.info(STARS)
+                bot.info("Aucun fichier audio sélectionné : consulter les logs si ERREUR/WARNING")
+                bot.detail(STARS)
+        elif files:
+            if settings.workers > 1:
+                bot.info(f"Traitement parallèle : {settings.workers} fichiers au maximum simultanément")
+            # avec changeLimit seuls les meilleurs candidats sont retenus, les suivants sont demandés si besoin
+            while files:
+                bot.info(STARS)
+                bot.info(f"Traitement des actions pour {str(len(files))} fichier(s)")
+                bot.detail(STARS)
+                if not process_files(files):
+                    bot.info(bot.stop_reason())
                     break
+                files = files.more()
         else:
             bot.info(STARS)
             bot.info("Aucun fichier audio sélectionné : consulter les logs si ERREUR/WARNING")
             bot.detail(STARS)
         bot.info()
+        # avant la fin de l'analyse : les erreurs distantes comptent pour l'index, les répertoires et le curseur des logs
+        bot.wait_distant()
 
+    bot.report_deferred()
     bot.info("Fin du taggage synchronisé de Radio Ballade")
     bot.info()
+    if bot.budget is not None and bot.budget.deferred:
+        print(STARS)
+        print(f"    {len(bot.budget.deferred)} fichier(s) reporté(s) faute de temps")
     if bot.count_attention > 0 :
         print(STARS)
         print(f"    {bot.count_attention} WARNINGS(S) détecté(s)")
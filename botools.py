@@ -2,18 +2,37 @@ import os
 import shutil
 from typing import Any
 import unicodedata
-import subprocess
+import time
+import errno
+import sqlite3
+import json
+import hashlib
+import threading
+from collections import deque
+from queue import Queue, Empty, Full
+import heapq
+import random
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
 import mutagen
 from mutagen import MutagenError
 from mutagen.easyid3 import EasyID3
 from mutagen.mp3 import MP3
 from datetime import datetime , timedelta
 import re ,  sys, traceback
-from botag import bot
+from types import SimpleNamespace
+try:
+    import fcntl
+except ImportError:
+    # Windows : un fichier ouvert ne peut pas être renommé, le verrou n'est pas nécessaire
+    fcntl = None
 
 # CONSTANTS
 
 settings = None
+bot = None
 STARS = '************************************************************'
 ARTIST = 'artist'
 YEAR = 'date'
@@ -33,9 +52,19 @@ ID = 'id'
 FILENAME = 'filename'
 RELPATH = 'relpath'
 EXT = 'extension'
+MOVED_FROM = 'movedfrom'
+CP_BATCH = 'cpBatch'
+CP_SLOTS = 'cpSlots'
+DEFAULT_CP_SLOTS = 2
+CP_SLOTS_MARKER = 'nbSlots='
 PHY_MODELS = { SOURCE : '', CURRENT : "C#", PREVIOUS : "P#"}
 CURRENT_PREVIOUS = [CURRENT, PREVIOUS]
 ALL_ROOTS = [LOCAL, DISTANT]
+LOG_ERROR = 0
+LOG_WARNING = 1
+LOG_INFO = 2
+LOG_DETAIL = 3
+LOG_VERBOSE = 4
 SMALLER = 1
 BIGGER = 2
 EQUAL = 3
@@ -59,6 +88,72 @@ CALC_FILENAME={
 }
 EXCLUDE_FROM_TITLE = ['0000', '00', '', None]
 ID_KEYS = [YEAR, TRACK, RAW_TITLE]
+INDEX_COMMIT_EVERY = 100
+LOG_BUFFER_SIZE = 64 * 1024
+LOG_LEVEL_LIMIT = 1000
+LOG_PARTIAL_EXT = '.part'
+LOG_INTERRUPTED = '_[INTERROMPU]'
+TITLE_PART_CACHE_SIZE = 1024
+ID3_FRAMES = {3 : {'TPE1' : ARTIST, 'TYER' : YEAR, 'TRCK' : TRACK, 'TIT2' : TITLE},
+              4 : {'TPE1' : ARTIST, 'TDRC' : YEAR, 'TRCK' : TRACK, 'TIT2' : TITLE}}
+ID3_ENCODINGS = {0 : ('latin-1', b'\x00'), 1 : ('utf-16', b'\x00\x00'), 2 : ('utf-16-be', b'\x00\x00'), 3 : ('utf-8', b'\x00')}
+ID3_DATE_CONFLICTS = {3 : ('TDRC', 'TDAT', 'TIME'), 4 : ('TYER', 'TDAT', 'TIME')}
+ID3_DATE = re.compile(r'\d{4}(-\d\d(-\d\d)?)?$')
+MPEG_VERSIONS = [2.5, None, 2, 1]
+MPEG_BITRATES = {True : [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+                 False : [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]}
+MPEG_RATES = {1 : [44100, 48000, 32000], 2 : [22050, 24000, 16000], 2.5 : [11025, 12000, 8000]}
+MPEG_PROBE_SIZE = 8192
+COPY_PARTIAL_EXT = '.part'
+ID3V1_SIZE = 128
+PROPAGATE_RETAG = 'retag'
+PROPAGATE_COPY = 'copy'
+PROPAGATE_PATCH = 'patch'
+COPY_CHUNK_SIZE = 1024 * 1024
+# copies limitées en débit : blocs d'au plus un quart de seconde de débit
+IO_MIN_CHUNK_SIZE = 64 * 1024
+IO_HOURS = re.compile(r'(\d{1,2}):(\d\d)-(\d{1,2}):(\d\d)$')
+COPY_FALLBACK_ERRORS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF, errno.ENOTSUP, errno.ENOTSOCK}
+COPY_METHODS = [lambda source, dest, count, offset, dest_offset : os.copy_file_range(source, dest, count, offset, dest_offset)] \
+                    if hasattr(os, 'copy_file_range') else []
+if hasattr(os, 'sendfile'):
+    COPY_METHODS.append(lambda source, dest, count, offset, dest_offset : os.sendfile(dest, source, offset, count))
+NOT_ALPHANUM = re.compile(r'[\W_]+')
+ANY_LINE = re.compile('(^)(.*)')
+QUOTED_PATH = re.compile('"(.+/.+)"')
+STAGE_WALK = 'walk'
+STAGE_FILENAME_MATCH = 'filename_match'
+STAGE_ARTIST_LOOKUP = 'artist_lookup'
+STAGE_TAG_PARSE = 'tag_parse'
+STAGE_TAG_SAVE = 'tag_save'
+STAGE_LOCAL_COPY = 'local_copy'
+STAGE_DISTANT_COPY = 'distant_copy'
+STAGE_RENAME = 'rename'
+STAGE_LOG_WRITE = 'log_write'
+METRIC_LABELS = {STAGE_WALK : 'Parcours des dossiers', STAGE_FILENAME_MATCH : 'Analyse des noms', STAGE_ARTIST_LOOKUP : 'Recherche artiste',
+                 STAGE_TAG_PARSE : 'Lecture des tags', STAGE_TAG_SAVE : 'Ecriture des tags', STAGE_LOCAL_COPY : 'Copie locale',
+                 STAGE_DISTANT_COPY : 'Copie distante', STAGE_RENAME : 'Renommage', STAGE_LOG_WRITE : 'Ecriture du log'}
+METRICS_EXT = '_mesures.json'
+METRIC_SAMPLES = 4096
+NO_STAGE = nullcontext()
+STREAM_QUEUE_SIZE = 1000
+STREAM_END = None
+# sélection des meilleurs candidats quand changeLimit est fixé : marge pour les fichiers finalement inchangés
+SELECT_MARGIN = 4
+SELECT_MIN = 100
+# opérations dont le coût est mesuré pour le temps alloué au traitement
+OP_CHECK = 'check'
+OP_ROTATION = 'rotation'
+# journal de reprise : position du fichier dans la liste des candidats et états des copies/déplacements
+JOURNAL_POS = 'journalPos'
+JOURNAL_VERSION = 1
+JOURNAL_COPY = 'copy'
+JOURNAL_MOVE = 'move'
+STEP_START = 'start'
+STEP_COPIED = 'copied'
+STEP_TAGGED = 'tagged'
+STEP_LOCAL = 'local'
+STEP_DONE = 'done'
 
 # FUNCTIONS
 
@@ -90,7 +185,7 @@ def format_to_unixpath(path: str, is_dir=False, reverse = False, remove_quotes =
 
 def normalize_name(a) -> str:
     """ retoune une chaine de caractères uniquement alphanumérique en minuscule et sans accent ni espace."""
-    return re.sub(r'[\W_]+', '', remove_accents(a.lower()))
+    return NOT_ALPHANUM.sub('', remove_accents(a.lower()))
 
 def remove_accents(s):
     return ''.join(c for c in unicodedata.normalize('NFD', s)
@@ -106,13 +201,36 @@ def str_compare(a, b) -> int:
     else:
         return SMALLER
 
+def cp_id(file_id):
+    """ identifiant de classement current/previous d'un fichier sélectionné, identique à TagsModel.getCalcID """
+    return "{:04.0f}".format(int(file_id[YEAR])) + "{:02.0f}".format(int(file_id[TRACK] or "0")) + file_id[RAW_TITLE]
+
+def slot_model(rank):
+    """ modèle de l'emplacement de rang rank : current, previous puis previous2, previous3... """
+    if rank == 0:
+        return CURRENT
+    if rank == 1:
+        return PREVIOUS
+    return PREVIOUS + str(rank)
+
+def base_model(model):
+    """ modèle de référence des tables PHY_MODELS, TITLE_SUM_KEYS et CALC_FILENAME : previousN se traite comme previous """
+    if model not in PHY_MODELS and model.startswith(PREVIOUS):
+        return PREVIOUS
+    return model
+
+def short_model(model):
+    """ abrégé du modèle dans le titre : C#, P#, puis P2#, P3#... """
+    if model in PHY_MODELS:
+        return PHY_MODELS[model]
+    return f'P{model[len(PREVIOUS):]}#'
+
 def split_filepath(full_pathname):
     global settings
     path_tab = full_pathname.rsplit('/', maxsplit=1)
     path = path_tab[0]+'/'
     filename = path_tab[1]
-    find = '(' + '|'.join(settings.root[x] for x in settings.root)+ r')(.*)'
-    match = re.search(find, path, re.I)
+    match = settings.patterns.root.search(path)
     if match:
         relpath = match.group(2)
         return relpath, filename
@@ -132,8 +250,8 @@ def format_field(func):
         value = func(*args, **kwargs)
         key = args[1]
         make_filter = False
-        if 'makeFilter' in  kwargs:
-            make_filter = kwargs['makeFilter']
+        if 'make_filter' in  kwargs:
+            make_filter = kwargs['make_filter']
         if key == YEAR:
             return "{:04.0f}".format(int(value))
         elif key == TRACK:
@@ -147,6 +265,122 @@ def format_field(func):
         return value
     return inner
 
+def lock_file(target):
+    """ verrou exclusif non bloquant sur un fichier ouvert, libéré à sa fermeture ou à l'arrêt du processus
+        retourne False si un autre processus le détient """
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(target.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return False
+    return True
+
+def copy_file(source_file, dest_file):
+    """ copie un fichier dans le noyau quand le système le permet (copy_file_range, sendfile), par blocs sinon
+        la copie est écrite dans un fichier temporaire puis renommée, les métadonnées sont conservées
+        retourne le nombre d'octets copiés et la durée de la copie, lève BTCopyError en cas d'échec """
+    start = time.perf_counter()
+    temp_file = dest_file + COPY_PARTIAL_EXT
+    bot.io.acquire()
+    try:
+        with open(source_file, 'rb') as source, open(temp_file, 'wb') as dest:
+            size = os.fstat(source.fileno()).st_size
+            copied = copy_content(source, dest, size)
+        shutil.copystat(source_file, temp_file)
+        if copied != size or os.path.getsize(temp_file) != size:
+            raise OSError(f'{copied} octets copiés sur {size}')
+        os.replace(temp_file, dest_file)
+    except OSError as e:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise BTCopyError(source_file, dest_file, e)
+    return copied, time.perf_counter() - start
+
+def copy_content(source, dest, size, offset=0, dest_offset=0):
+    """ copie size octets de source à partir de offset vers dest à partir de dest_offset, retourne le nombre d'octets copiés
+        avec un débit limité, la copie est faite par petits blocs soumis au limiteur d'entrées/sorties """
+    copied = 0
+    chunk = bot.io.chunk_size()
+    for method in COPY_METHODS:
+        try:
+            dest.seek(dest_offset + copied)
+            while copied < size:
+                count = min(size - copied, chunk or COPY_CHUNK_SIZE * 64)
+                bot.io.acquire(count, 0)
+                sent = method(source.fileno(), dest.fileno(), count, offset + copied, dest_offset + copied)
+                if not sent:
+                    # la méthode ne copie plus rien avant la fin : la suivante reprend à la position atteinte
+                    break
+                copied += sent
+        except OSError as e:
+            if e.errno not in COPY_FALLBACK_ERRORS:
+                raise
+        if copied >= size:
+            return copied
+    source.seek(offset + copied)
+    dest.seek(dest_offset + copied)
+    buffer = memoryview(bytearray(COPY_CHUNK_SIZE))
+    while copied < size:
+        count = min(size - copied, chunk or COPY_CHUNK_SIZE)
+        bot.io.acquire(count, 0)
+        read = source.readinto(buffer[:count])
+        if not read:
+            return copied
+        dest.write(buffer[:read])
+        copied += read
+    return copied
+
+def id3_tag_size(header):
+    """ taille totale du tag ID3v2 d'après ses 10 premiers octets, 0 si absent """
+    if len(header) != 10 or header[:3] != b'ID3':
+        return 0
+    size = HeaderTags.syncsafe(header[6:10])
+    if size is None:
+        return 0
+    return size + 10 + (10 if header[5] & 0x10 else 0)
+
+def file_tag_size(full_pathname):
+    """ taille du tag ID3v2 d'un fichier, 0 si absent ou illisible """
+    try:
+        with open(full_pathname, 'rb') as source:
+            return id3_tag_size(source.read(10))
+    except OSError:
+        return 0
+
+def patch_tags(source_file, dest_file):
+    """ recopie uniquement les tags de source_file dans dest_file, le contenu audio étant identique
+        possible seulement si les fichiers et leurs tags ID3v2 ont la même taille
+        retourne le nombre d'octets écrits, None si le remplacement n'est pas possible """
+    size = bot.dircache.getsize(source_file)
+    if size != bot.dircache.getsize(dest_file):
+        return None
+    with open(source_file, 'rb') as source:
+        tag_size = id3_tag_size(source.read(10))
+        source.seek(0)
+        block = source.read(tag_size)
+        source.seek(max(size - ID3V1_SIZE, 0))
+        tail = source.read(ID3V1_SIZE)
+    if not tag_size or tag_size >= size:
+        return None
+    bot.io.acquire(tag_size)
+    with open(dest_file, 'r+b') as dest:
+        if id3_tag_size(dest.read(10)) != tag_size:
+            return None
+        blocks = [(0, block)]
+        if tail[:3] == b'TAG':
+            blocks.append((size - ID3V1_SIZE, tail))
+        for position, data in blocks:
+            dest.seek(position)
+            dest.write(data)
+        dest.flush()
+        for position, data in blocks:
+            dest.seek(position)
+            if dest.read(len(data)) != data:
+                raise OSError(f'tags relus différents dans {dest_file}')
+    shutil.copystat(source_file, dest_file)
+    return sum(len(data) for _, data in blocks)
+
 # ExceptionS
     
 class BTException(Exception):
@@ -164,16 +398,28 @@ class BTArtistNotFound(BTException):
         super().__init__(message)
 
 class BTTagError(BTException):
-    def __init__(self, model, root) -> None:
-        filename = bot.audio.get_full_filepath(model, root)
+    def __init__(self, model, root, filename=None) -> None:
+        if filename is None:
+            filename = bot.audio.get_full_filepath(model, root)
         message = f'lors de l\'écriture des tags dans {filename}'
         super().__init__(message)
 
 class BTCopyError(BTException):
-    def __init__(self, from_file, to_file) -> None:
+    def __init__(self, from_file, to_file, e=None) -> None:
         message = f'lors de la copie du fichier {from_file} vers {to_file}'
+        if e:
+            message += f'\nDétail : {e}'
+        super().__init__(message)
+
+class BTTagOverflow(BTException):
+    def __init__(self, filename) -> None:
+        message = f'place insuffisante pour réécrire les tags de {filename} sur place'
         super().__init__(message)
 
+class BTScanStopped(BTException):
+    def __init__(self) -> None:
+        super().__init__("Analyse interrompue : le traitement des fichiers est terminé")
+
 class BTMoveError(BTException):
     def __init__(self, from_file, to_file, e) -> None:
         message = f'lors du déplacement du fichier {from_file} vers {to_file}\nDétail : {e}'
@@ -181,20 +427,208 @@ class BTMoveError(BTException):
 
 # Classes
 
+class PatternSet():
+    """ Expressions régulières compilées une seule fois au chargement des paramètres """
+
+    def __init__(self, _settings):
+        self.audio = re.compile(_settings.audioSignature, re.I)
+        self.root = re.compile('(' + '|'.join(_settings.root[x] for x in _settings.root) + r')(.*)', re.I)
+        self.action_lines = [[re.compile(line, re.I) for line in row] for row in _settings.syncActionLine]
+        # en-têtes de toutes les actions réunis pour rechercher les lignes candidates en une seule passe
+        self.action_heads = re.compile('|'.join(f'(?P<action{i}>{row[0]})' for i, row in enumerate(_settings.syncActionLine)),
+                                       re.I | re.M)
+
+    @staticmethod
+    @lru_cache(maxsize=TITLE_PART_CACHE_SIZE)
+    def title_part(value):
+        """ motif retirant une valeur de tag (année, piste, durée...) d'un titre
+            les valeurs se répètent d'un fichier à l'autre : les motifs les plus récents restent compilés """
+        return re.compile(r'\s?' + value + r'\s?-?', re.I)
+
+
+class Metrics():
+    """ Nombre d'appels et durées des principales étapes du traitement
+
+        Désactivé, stage() retourne un contexte vide partagé et iterate() l'itérable tel quel :
+        le coût se limite à un appel de méthode par étape.
+        Chaque étape conserve ses totaux et un échantillon de taille fixe pour les centiles : la mémoire ne dépend pas du nombre de fichiers.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.durations = {}
+        self.lock = threading.Lock()
+        self.random = random.Random(0)
+
+    def stage(self, name):
+        if not self.enabled:
+            return NO_STAGE
+        return MetricStage(self, name)
+
+    def add(self, name, seconds):
+        with self.lock:
+            series = self.durations.get(name)
+            if series is None:
+                series = self.durations[name] = MetricSeries()
+            series.add(seconds, self.random)
+
+    def iterate(self, iterable, name):
+        """ mesure le temps passé à obtenir chaque élément d'un itérable (parcours de l'arborescence) """
+        if not self.enabled:
+            return iterable
+        return self.timed_iterate(iterable, name)
+
+    def timed_iterate(self, iterable, name):
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(name, time.perf_counter() - start)
+                return
+            self.add(name, time.perf_counter() - start)
+            yield item
+
+    def summary(self):
+        """ retourne par étape : nombre, durée totale, moyenne, minimum, médiane, 95e centile et maximum (en secondes) """
+        result = {}
+        for name in sorted(self.durations, key=lambda x : list(METRIC_LABELS).index(x) if x in METRIC_LABELS else len(METRIC_LABELS)):
+            series = self.durations[name]
+            values = sorted(series.samples)
+            result[name] = {'count' : series.count, 'total' : series.total, 'mean' : series.total / series.count, 'min' : series.min,
+                            'p50' : values[(len(values) - 1) // 2], 'p95' : values[min(len(values) - 1, int(len(values) * 0.95))],
+                            'max' : series.max}
+        return result
+
+    def report(self):
+        """ lignes du résumé écrit en fin de log """
+        lines = [f"{'Etape':<22}{'Nombre':>9}{'Total (s)':>12}{'Moyenne (ms)':>14}{'Médiane (ms)':>14}{'95% (ms)':>11}{'Max (ms)':>11}"]
+        for name, values in self.summary().items():
+            lines.append(f"{METRIC_LABELS.get(name, name):<22}{values['count']:>9}{values['total']:>12.3f}"
+                         f"{values['mean'] * 1000:>14.3f}{values['p50'] * 1000:>14.3f}{values['p95'] * 1000:>11.3f}{values['max'] * 1000:>11.3f}")
+        return lines
+
+    def write(self, path, **context):
+        """ écrit le résumé en JSON avec les informations du traitement """
+        try:
+            with open(path, 'w', encoding='utf-8') as target:
+                json.dump(dict(context, stages=self.summary()), target, indent=1)
+        except OSError as e:
+            bot.error(f"Enregistrement impossible des mesures {path}\nDétail : {e}")
+            return False
+        return True
+
+
+class MetricSeries():
+    """ durées d'une étape : nombre, total, minimum, maximum et échantillon aléatoire uniforme de METRIC_SAMPLES valeurs au plus """
+
+    __slots__ = ('count', 'total', 'min', 'max', 'samples')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.samples = []
+
+    def add(self, seconds, rand):
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+        if len(self.samples) < METRIC_SAMPLES:
+            self.samples.append(seconds)
+        else:
+            # chaque valeur reste dans l'échantillon avec la probabilité METRIC_SAMPLES / count
+            slot = rand.randrange(self.count)
+            if slot < METRIC_SAMPLES:
+                self.samples[slot] = seconds
+
+
+class MetricStage():
+    """ contexte mesurant la durée d'une étape """
+
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.metrics.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class TimeBudget():
+    """ Temps alloué au traitement
+
+        La durée du fichier suivant est estimée par le coût moyen mesuré pendant le traitement pour son type d'opération :
+        vérification simple ou rotation current/previous. Le fichier n'est pas commencé s'il ne peut finir avant l'échéance.
+    """
+
+    def __init__(self, seconds, start):
+        self.deadline = start + seconds
+        self.costs = {}
+        self.deferred = []
+        self.exhausted = False
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def operation(file_id):
+        return OP_ROTATION if file_id['processCP'] else OP_CHECK
+
+    def record(self, file_id, seconds):
+        with self.lock:
+            cost = self.costs.setdefault(self.operation(file_id), [0, 0.0])
+            cost[0] += 1
+            cost[1] += seconds
+
+    def estimate(self, file_id):
+        with self.lock:
+            count, total = self.costs.get(self.operation(file_id), (0, 0.0))
+            if not count:
+                # pas encore de mesure pour cette opération : moyenne de toutes les opérations
+                count = sum(cost[0] for cost in self.costs.values())
+                total = sum(cost[1] for cost in self.costs.values())
+        return total / count if count else 0.0
+
+    def allows(self, file_id, delay=0.0):
+        """ delay : attente connue d'avance avant le début du fichier (limite des entrées/sorties) """
+        if not self.exhausted and time.perf_counter() + delay + self.estimate(file_id) > self.deadline:
+            self.exhausted = True
+        return not self.exhausted
+
+    def defer(self, files):
+        with self.lock:
+            self.deferred.extend(files)
+
+
 class Logger():
     
     def __init__(self, screen_level, file_level) -> None:
 
+        global bot
+        bot = self
         self.wrapper = None
         self.log_filename = None
         self.screen_level = screen_level
         self.file_level = file_level
+        self.level = max(screen_level, file_level)
         self.count_attention = 0
         self.count_error = 0
         self.count_line = 0
-        self.history = []
+        self.backlog = []
+        self.level_messages = {0 : deque(maxlen=LOG_LEVEL_LIMIT), 1 : deque(maxlen=LOG_LEVEL_LIMIT)}
         self.time_stamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
         self.change_count = 0
+        self.lock = threading.RLock()
+        self.local = threading.local()
+        self.metrics = Metrics()
  
     def __enter__(self):
         return self
@@ -204,9 +638,12 @@ class Logger():
         return False
     
     def open(self):
+        """ ouvre le fichier log sous un nom provisoire, renommé à la fermeture suivant les erreurs rencontrées """
 
         try:
-            self.wrapper = open(self.log_filename ,"w", encoding="utf-8")
+            self.wrapper = open(self.log_filename + LOG_PARTIAL_EXT, "w", encoding="utf-8", buffering=LOG_BUFFER_SIZE)
+            # un autre lancement ne récupère pas le log provisoire d'un traitement en cours
+            lock_file(self.wrapper)
         except OSError as e :
             print(f"Création impossible du fichier des logs : {self.log_filename}" )
             print(f"Détail : {e}")
@@ -215,38 +652,65 @@ class Logger():
         else:
             return True        
 
-    def write_logs(self):
-
-        self.wrapper.write("\tCréation du fichier log " + self.log_filename+ '\n')
-        for message in self.history:
-            if message[0] <= self.file_level: 
-                self.wrapper.write("{:05.0f}".format(message[2]) + f' : {message[1]}' )
-        if self.count_attention + self.count_error >0:
-            self.wrapper.write("\nLISTES DES ERREURS / ATTENTIONS\n")
-            self.wrapper.write(self.get_levelmessage(1))
-            self.wrapper.write(self.get_levelmessage(0))
-        self.history = None
-    
+    def write_log(self, p_level, message, line):
+        if p_level <= self.file_level:
+            with self.metrics.stage(STAGE_LOG_WRITE):
+                self.wrapper.write("{:05.0f}".format(line) + f' : {message}' )
+                if p_level == 0:
+                    # une erreur peut précéder un arrêt brutal : elle est écrite immédiatement
+                    self.wrapper.flush()
+
     def close(self):
         
         """ Compute some counts and close the logfile
         """
         
-        if self.history is not None and self.log_filename is not None:
+        if self.wrapper is not None:
+            if self.count_attention + self.count_error >0:
+                self.wrapper.write("\nLISTES DES ERREURS / ATTENTIONS\n")
+                self.wrapper.write(self.get_levelmessage(1))
+                self.wrapper.write(self.get_levelmessage(0))
+            self.wrapper.close()
+            self.wrapper = None
+            partial_filename = self.log_filename + LOG_PARTIAL_EXT
             if self.count_error:
                 self.log_filename += '_[ERREUR]'
             elif self.count_attention:
                 self.log_filename += '_[ATTENTION]'
             self.log_filename +='.log'
-            if self.open():
-                self.write_logs()
-                self.wrapper.close()
+            try:
+                os.replace(partial_filename, self.log_filename)
+            except OSError as e:
+                print(f"Renommage impossible du fichier des logs : {partial_filename}\nDétail : {e}")
+                self.log_filename = partial_filename
     
+    def recover_partial(self, directory, mask):
+        """ un log provisoire laissé par un arrêt brutal est renommé en log interrompu, que la rotation supprimera """
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return
+        for name in names:
+            if not (name.startswith(mask) and name.endswith(LOG_PARTIAL_EXT)):
+                continue
+            partial_filename = directory + name
+            log_filename = partial_filename[:-len(LOG_PARTIAL_EXT)] + LOG_INTERRUPTED + '.log'
+            try:
+                with open(partial_filename, 'rb') as partial:
+                    # log d'un traitement encore en cours : verrouillé (Linux) ou impossible à renommer (Windows)
+                    if not lock_file(partial):
+                        continue
+                    os.replace(partial_filename, log_filename)
+            except OSError:
+                continue
+            self.warning(f"Log d'un traitement interrompu récupéré : {log_filename}")
+
     def get_levelmessage(self, level):
-        res = ''
-        for message in bot.history:
-            if message[0] == level:
-                res += message[1]                
+        count = self.count_error if level == 0 else self.count_attention
+        messages = self.level_messages[level]
+        res = ''.join(messages)
+        if count > len(messages):
+            res = f"... {count - len(messages)} message(s) précédent(s) non repris\n" + res
         return res
     
     def start(self, _setting):
@@ -256,15 +720,24 @@ class Logger():
         self.scan_list = {_setting.logPath:_setting.logMask, _setting.syncPath : _setting.syncSignature}
         self.screen_level = _setting.logScreenLevel
         self.file_level = _setting.logFileLevel
+        self.level = max(self.screen_level, self.file_level)
+        self.metrics.enabled = _setting.logMetrics
         if self.file_level > 0:
+            self.recover_partial(_setting.logPath, _setting.logMask)
             self.log_filename = _setting.logPath + _setting.logMask + '_' + datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+            if self.open():
+                with self.lock:
+                    self.wrapper.write("\tCréation du fichier log " + self.log_filename + '\n')
+                    for p_level, message, line in self.backlog:
+                        self.write_log(p_level, message, line)
+        self.backlog = None
         self.info('Logger démarré')
 
     def rotate_file(self, file, directory, signature):
         limit_date = datetime.now() - timedelta(days=settings.logLimit)
 
         if re.search(signature, file, re.IGNORECASE):
-            self.verbose(f"Analyse fichier sélectionné {file}")
+            self.verbose("Analyse fichier sélectionné %s", file)
             tsf = datetime.fromtimestamp(os.path.getmtime(directory + file)) # get timestamp
             if tsf < limit_date:
                 if not settings.noAction:
@@ -273,69 +746,230 @@ class Logger():
                 else :
                     self.detail(f"NoAction : Non Suppression du fichier log {directory}/{file}")
             else:
-                self.verbose(f'Fichier conservé :{file}')
+                self.verbose('Fichier conservé :%s', file)
 
     
     def rotate(self):
         """ erase old files log """
         for directory, signature in self.scan_list.items():
-            self.detail("Analyse répertoire {directory}")
-            self.verbose("Signature " + signature)
+            self.detail("Analyse répertoire %s", directory)
+            self.verbose("Signature %s", signature)
             files_list = os.listdir(directory)
             for file in files_list:
                 self.rotate_file(file, directory , signature)             
 
-    def send(self, message, p_level ):
-        """ send message to terminal and/or logfile"""
+    def enabled(self, p_level):
+        """ indique si un message de ce niveau sera affiché ou écrit dans le fichier log
+            permet d'éviter de construire un message coûteux qui serait ignoré """
+        return p_level <= self.level or p_level <= LOG_WARNING or self.backlog is not None
+
+    def send(self, message, p_level, *args):
+        """ send message to terminal and/or logfile
+            message peut être une chaine à formater avec args (%) ou une fonction retournant la chaine :
+            dans ces deux cas, rien n'est calculé si le message n'est ni affiché ni écrit
+            avant start() le niveau du fichier log n'est pas connu : tous les messages sont conservés"""
+
+        if not self.enabled(p_level):
+            return
+        if callable(message):
+            message = message()
+        elif args:
+            message = message % args
 
         if p_level == 0:
             message = "ERREUR : " + message
-            self.count_error += 1
         elif p_level == 1:
             message = "ATTENTION : " + message
+        if p_level <= 1:
+            self.local.faults = self.get_faults() + 1
+
+        group = getattr(self.local, 'group', None)
+        if group is not None:
+            # message retenu jusqu'à la fin du traitement du fichier pour ne pas mélanger les logs des threads
+            group.append((message, p_level))
+        else:
+            with self.lock:
+                self.emit(message, p_level)
+
+    def emit(self, message, p_level):
+        if p_level == 0:
+            self.count_error += 1
+        elif p_level == 1:
             self.count_attention += 1
 
         if p_level <= self.screen_level:
             print(message)
 
         message = message + '\n'
-        self.history.append([p_level, message, self.count_line])
+        if p_level in self.level_messages:
+            self.level_messages[p_level].append(message)
+        if self.wrapper is not None:
+            self.write_log(p_level, message, self.count_line)
+        elif self.backlog is not None:
+            # messages émis avant l'ouverture du fichier log
+            self.backlog.append((p_level, message, self.count_line))
         self.count_line += 1
 
-    def error(self, message=""):
-        self.send(message, 0)
+    @contextmanager
+    def grouped(self):
+        """ regroupe les messages du thread courant et les émet d'un bloc à la sortie """
+        self.local.group = []
+        try:
+            yield
+        finally:
+            group, self.local.group = self.local.group, None
+            with self.lock:
+                for message, p_level in group:
+                    self.emit(message, p_level)
+
+    def get_faults(self):
+        """ nombre d'erreurs et warnings émis par le thread courant """
+        return getattr(self.local, 'faults', 0)
 
-    def warning(self, message=""):
-        self.send(message, 1)
+    def error(self, message="", *args):
+        self.send(message, LOG_ERROR, *args)
 
-    def info(self, message=""):
-        self.send(message, 2)
+    def warning(self, message="", *args):
+        self.send(message, LOG_WARNING, *args)
 
-    def detail(self, message=""):
-        self.send(message, 3)
+    def info(self, message="", *args):
+        self.send(message, LOG_INFO, *args)
 
-    def verbose(self, message=""):
-        self.send(message, 4)
+    def detail(self, message="", *args):
+        self.send(message, LOG_DETAIL, *args)
+
+    def verbose(self, message="", *args):
+        self.send(message, LOG_VERBOSE, *args)
 
 
 class Engine(Logger):
 
     def __init__(self, screen_level, file_level) -> None:
 
-        self.audio = None
         super().__init__(screen_level, file_level)
-    
+        self.audio = None
+        self.index = None
+        self.journal = None
+        self.budget = None
+        self.distant = None
+        self.dircache = DirCache()
+        self.io = IOScheduler()
+        self.cp_index = {}
+        self.start_time = time.perf_counter()
+        self.scan_count = 0
+        self.scan_duration = 0.0
+        self.distant_bytes = 0
+        self.fail_count = 0
+
+    @property
+    def audio(self):
+        # le fichier audio en cours de traitement est propre à chaque thread
+        return getattr(self.local, 'audio', None)
+
+    @audio.setter
+    def audio(self, value):
+        self.local.audio = value
+
+    def start(self, _setting):
+        super().start(_setting)
+        self.dircache.enabled = _setting.dirCache
+        self.io = IOScheduler({True : (_setting.ioOnAirRate * 1024, _setting.ioOnAirOps),
+                               False : (_setting.ioOffAirRate * 1024, _setting.ioOffAirOps)},
+                              IOScheduler.parse_hours(_setting.ioOnAirHours))
+        if _setting.distAsync and _setting.makeDistCopy and not _setting.noAction:
+            self.distant = DistantQueue(_setting.distInFlight * 1024 * 1024)
+        if _setting.scanIndex:
+            self.index = ScanIndex(_setting.scanIndex)
+            self.index.open()
+        if _setting.runJournal and not _setting.noAction:
+            self.journal = Journal(_setting.runJournal)
+            self.journal.open()
+        if _setting.timeBudget > 0:
+            # l'échéance part du lancement : l'analyse est comprise dans le temps alloué
+            self.budget = TimeBudget(_setting.timeBudget, self.start_time)
+
+    def close(self):
+        self.wait_distant()
+        if self.io.waited:
+            self.detail("Entrées/sorties limitées : %.1f s d'attente au total", self.io.waited)
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if self.metrics.enabled:
+            self.report_metrics()
+        if settings is not None and settings.metricsPath:
+            self.export_prometheus(settings.metricsPath)
+        super().close()
+
+    def export_prometheus(self, path):
+        """ écrit les compteurs du traitement au format texte Prometheus (collecteur textfile de node-exporter)
+            le fichier est écrit sous un nom provisoire puis renommé pour ne jamais être lu incomplet """
+        values = [
+            ('botag_last_run_timestamp_seconds', 'gauge', "Date de fin du dernier traitement", time.time()),
+            ('botag_run_duration_seconds', 'gauge', "Durée totale du traitement", time.perf_counter() - self.start_time),
+            ('botag_scan_duration_seconds', 'gauge', "Durée de l'analyse (répertoire ou logs de synchronisation)", self.scan_duration),
+            ('botag_files_scanned', 'gauge', "Fichiers audio sélectionnés par l'analyse", self.scan_count),
+            ('botag_files_changed', 'gauge', "Fichiers audio modifiés", self.change_count),
+            ('botag_errors', 'gauge', "Erreurs rencontrées", self.count_error),
+            ('botag_warnings', 'gauge', "Avertissements rencontrés", self.count_attention),
+            ('botag_distant_bytes_copied', 'gauge', "Octets copiés vers la racine distante", self.distant_bytes),
+            ('botag_change_limit_reached', 'gauge', "1 si le traitement s'est arrêté sur la limite de changements", int(self.limit_reached())),
+            ('botag_files_deferred', 'gauge', "Fichiers reportés faute de temps", len(self.budget.deferred) if self.budget is not None else 0),
+            ('botag_io_wait_seconds', 'gauge', "Attente imposée par la limite des entrées/sorties", self.io.waited),
+        ]
+        lines = []
+        for name, kind, helptxt, value in values:
+            lines += [f'# HELP {name} {helptxt}', f'# TYPE {name} {kind}', f'{name} {value}']
+        if self.metrics.enabled:
+            summary = self.metrics.summary()
+            for name, key, helptxt in [('botag_stage_seconds', 'total', "Durée cumulée par étape"),
+                                       ('botag_stage_count', 'count', "Nombre d'exécutions par étape")]:
+                lines += [f'# HELP {name} {helptxt}', f'# TYPE {name} gauge']
+                lines += [f'{name}{{stage="{stage}"}} {stage_values[key]}' for stage, stage_values in summary.items()]
+        temp_path = path + '.tmp'
+        try:
+            with open(temp_path, 'w', encoding='utf-8', newline='\n') as target:
+                target.write('\n'.join(lines) + '\n')
+            os.replace(temp_path, path)
+        except OSError as e:
+            self.error(f"Enregistrement impossible des métriques {path}\nDétail : {e}")
+        else:
+            self.detail(f"Métriques enregistrées : {path}")
+
+    def report_metrics(self):
+        """ résumé des mesures en fin de log et fichier JSON à côté du log """
+        self.info(STARS)
+        self.info("Mesures des étapes du traitement")
+        for line in self.metrics.report():
+            self.info(line)
+        self.info(STARS)
+        if self.log_filename:
+            self.metrics.write(self.log_filename + METRICS_EXT, date=self.time_stamp, changes=self.change_count,
+                               errors=self.count_error, warnings=self.count_attention)
+
     def manageAudioSet(self, file_id):
+        start = time.perf_counter()
+        interrupted = False
         try:
             filename = file_id[RELPATH] + file_id[FILENAME]
+            full_pathname = settings.root[LOCAL] + filename
+            if self.index is not None and self.index.is_unchanged(file_id[RELPATH], file_id[FILENAME], full_pathname):
+                if self.enabled(LOG_DETAIL):
+                    self.detail(f"Fichier inchangé depuis sa dernière vérification : {filename}")
+                return
             self.info(f"Fichier sélectionné : {filename}")
+            faults = self.get_faults()
+            self.wait_artist(file_id[ARTIST])
             self.audio = AudioFile(file_id)
 
             self.info(f"Emission/artiste présent dans la liste des émissions : {file_id[ARTIST]}" )
                 # need to update tags
             tags = self.audio.models[SOURCE]
-            self.detail(f"Tags calculés à partir du nom du fichier : {tags.strID(calc= True)}")
-            self.detail(f"Tags enregistrés dans le fichier         : {tags.strID()}")
+            self.detail(lambda: f"Tags calculés à partir du nom du fichier : {tags.strID(calc= True)}")
+            self.detail(lambda: f"Tags enregistrés dans le fichier         : {tags.strID()}")
             if not self.audio.check_filetags(SOURCE):
                 self.info("Fichier incorrectement taggé - > sauvegarde des tags")
                 self.audio.correct_filetags_info(SOURCE)
@@ -343,7 +977,7 @@ class Engine(Logger):
                 self.info("Fichier correctement taggé")
             if self.audio.process_cp:
                 #les fichiers currents et previous doivent étre gérés
-                self.audio.manage_cp()
+                self.audio.cp_state = self.audio.manage_cp()
             else:
                 self.info("Pas de gestion des current/previous pour ce fichier")
             if self.audio.check_filename(SOURCE) !=  EQUAL:
@@ -356,22 +990,267 @@ class Engine(Logger):
                     self.warning(f"Fichier {filename} incorrectement nommé mais pas de renommage - voir RBTagger.ini")
 
             if self.audio.has_changed:
-                self.change_count += 1
+                self.count_change()
+            if self.index is not None and not settings.noAction:
+                if self.get_faults() == faults:
+                    # fichier vérifié sans erreur ni warning : il ne sera plus analysé tant qu'il ne change pas
+                    self.index_verified(file_id, self.audio)
+                else:
+                    self.index.remove(file_id[RELPATH], file_id[FILENAME])
         except BTException as e:
+            self.count_failure()
+            self.release_cp(file_id)
             self.error(str(e))        
         except Exception as e:
-            self.change_count += 1
+            self.count_change()
+            self.count_failure()
+            self.release_cp(file_id)
             self.error(get_error_message())
             self.info("Erreur non gérée : fin du traitement du fichier audio" )
+        except BaseException:
+            # arrêt du programme : le fichier reste à traiter dans le journal de reprise
+            interrupted = True
+            raise
+        finally:
+            if self.budget is not None:
+                self.budget.record(file_id, time.perf_counter() - start)
+            if self.journal is not None and not interrupted:
+                self.journal.done(file_id)
 		    
+    def manageAudioBatch(self, files, workers):
+        """ traite les fichiers en parallèle avec au plus workers threads
+            les fichiers d'un même artiste sont traités un par un dans l'ordre de la liste
+            car ils partagent les fichiers current et previous
+
+        Returns:
+            bool: False si le traitement s'est arrêté sur la limite de changements
+        """
+        pending = {}
+        for file_id in files:
+            pending.setdefault(file_id[ARTIST], deque()).append(file_id)
+        ready = deque(pending)
+        running = {}
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while ready or running:
+                # chaque fichier en cours peut compter un changement : la limite n'est jamais dépassée
+                while ready and len(running) < workers and not self.limit_reached(len(running)):
+                    if not self.budget_allows(pending[ready[0]][0]):
+                        break
+                    artist = ready.popleft()
+                    running[pool.submit(self.manageGroupedAudioSet, pending[artist].popleft())] = artist
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    artist = running.pop(future)
+                    if pending[artist]:
+                        ready.append(artist)
+        if self.budget is not None and self.budget.exhausted:
+            self.defer([file_id for artist in ready for file_id in pending[artist]])
+        return not ready
+
+    def plan_cp(self, files):
+        """ prépare la rotation current/previous de chaque artiste pour l'ensemble du lot
+            seuls les N fichiers les plus récents d'un artiste (N emplacements) peuvent occuper current et previous :
+            les autres ne gèrent pas les current/previous et les N retenus sont traités du plus récent au plus ancien
+            le plus récent connaît les suivants pour leur réserver leur emplacement : chaque emplacement est écrit une fois
+
+        Returns:
+            list: les fichiers dans l'ordre de traitement
+        """
+        files = list(files)
+        positions = {}
+        for position, file_id in enumerate(files):
+            if not file_id['processCP']:
+                continue
+            full_pathname = settings.root[LOCAL] + file_id[RELPATH] + file_id[FILENAME]
+            if self.index is not None and self.index.is_unchanged(file_id[RELPATH], file_id[FILENAME], full_pathname):
+                continue
+            positions.setdefault(file_id[ARTIST], []).append(position)
+        for artist, artist_positions in positions.items():
+            ranked = sorted(artist_positions, key=lambda position : cp_id(files[position]), reverse=True)
+            slots = files[ranked[0]].get(CP_SLOTS, DEFAULT_CP_SLOTS)
+            for position in ranked[slots:]:
+                self.detail("Current/previous : %s plus ancien que %d fichiers du lot, pas de rotation", files[position][FILENAME], slots)
+                files[position] = dict(files[position], processCP=False)
+            planned = [files[position] for position in ranked[:slots]]
+            if len(planned) > 1:
+                planned[0] = dict(planned[0], **{CP_BATCH : [cp_id(file_id) for file_id in planned[1:]]})
+            for position, file_id in zip(sorted(ranked[:slots]), planned):
+                files[position] = file_id
+        return files
+
+    def manageAudioStream(self, files):
+        """ traite les fichiers au fur et à mesure de l'analyse
+
+        Returns:
+            int: nombre de fichiers traités, None si le traitement s'est arrêté sur la limite de changements
+        """
+        count = 0
+        for file_id in files:
+            if not self.budget_allows(file_id):
+                self.defer([file_id])
+                files.close()
+                return None
+            if self.journal is not None:
+                self.journal.register([file_id])
+            self.info()
+            self.manageAudioSet(file_id)
+            count += 1
+            if self.limit_reached():
+                files.close()
+                return None
+        return count
+
+    def manageGroupedAudioSet(self, file_id):
+        with self.grouped():
+            self.info()
+            self.manageAudioSet(file_id)
+
+    def count_change(self):
+        with self.lock:
+            self.change_count += 1
+
+    def count_failure(self):
+        """ fichier dont le traitement s'est terminé en erreur """
+        with self.lock:
+            self.fail_count += 1
+
+    def release_cp(self, file_id):
+        """ fichier en échec avant sa copie current/previous : son emplacement réservé est vide,
+            il sera comblé à la prochaine rotation de l'artiste ou à la lecture des emplacements du prochain traitement """
+        slots = self.cp_index.get(file_id[ARTIST])
+        if slots is None or not file_id['processCP']:
+            return
+        key = cp_id(file_id)
+        if key in slots[1]:
+            slots[1].discard(key)
+            slots[2].add(key)
+
+    def count_distant_bytes(self, size):
+        with self.lock:
+            self.distant_bytes += size
+
+    def distant_op(self, file_id, description, size, operation, *args):
+        """ exécute une opération sur la racine distante, en arrière-plan si distAsync """
+        if self.distant is None:
+            operation(*args)
+        else:
+            self.distant.submit(file_id, description, size, operation, *args)
+
+    def index_verified(self, file_id, audio):
+        """ enregistre dans l'index un fichier vérifié sans erreur
+            avec distAsync l'enregistrement suit ses opérations distantes en arrière-plan et n'a lieu que si elles réussissent """
+        if self.distant is None:
+            self.index.update(audio, audio.get_full_filepath())
+        else:
+            self.distant.then(file_id, self.index_distant, self.distant, file_id, audio, audio.get_full_filepath())
+
+    def index_distant(self, distant, file_id, audio, full_pathname):
+        if not distant.has_failed(file_id):
+            self.index.update(audio, full_pathname)
+
+    def wait_artist(self, artist):
+        """ attend la fin des opérations distantes en arrière-plan qui relisent les fichiers locaux de l'artiste """
+        if self.distant is not None:
+            self.distant.wait(artist)
+
+    def wait_distant(self):
+        """ barrière avant le résumé : attend la fin des opérations distantes en arrière-plan et signale leurs erreurs """
+        if self.distant is None:
+            return
+        distant, self.distant = self.distant, None
+        self.info(f"Attente de la fin des opérations distantes : {distant.count} opération(s) déposée(s)")
+        failures = distant.barrier()
+        for file_id, description, error in failures:
+            # le fichier n'a pas été enregistré dans l'index : il sera vérifié à nouveau au prochain traitement
+            self.count_failure()
+            self.error(f"{file_id[RELPATH]}{file_id[FILENAME]} : échec de l'opération distante\n{description}\nDétail : {error}")
+            if self.journal is not None:
+                self.info("La copie distante sera réalignée sur le fichier local au prochain lancement (journal de reprise)")
+        if failures:
+            self.error(f"{len(failures)} opération(s) distante(s) en échec sur {distant.count}")
+        else:
+            self.detail("Opérations distantes terminées")
+
+    def limit_reached(self, in_progress=0):
+        return settings.changeLimit > 0 and self.change_count + in_progress >= settings.changeLimit
+
+    def budget_allows(self, file_id):
+        return self.budget is None or self.budget.allows(file_id, self.io.backlog())
+
+    def defer(self, files):
+        if self.budget is not None:
+            self.budget.defer(files)
+
+    def stop_reason(self):
+        if self.budget is not None and self.budget.exhausted:
+            return 'Le temps alloué au traitement est écoulé, relancer pour continuer'
+        return 'Le nombre de changements effectués a atteint la limite , relancer pour continuer'
+
+    def prioritize(self, files):
+        """ ordre de traitement avec un temps alloué : le plus récent de chaque émission, puis les émissions
+            avec current/previous, puis les autres fichiers, chaque groupe du plus récent au plus ancien
+            les fichiers d'une même rotation current/previous restent groupés derrière le plus récent de l'émission """
+        newest = {}
+        planned = {}
+        for file_id in files:
+            newest[file_id[ARTIST]] = max(newest.get(file_id[ARTIST], ''), cp_id(file_id))
+            for key in file_id.get(CP_BATCH, []):
+                planned[(file_id[ARTIST], key)] = cp_id(file_id)
+
+        def priority(file_id):
+            key = cp_id(file_id)
+            group = planned.get((file_id[ARTIST], key))
+            if group is not None:
+                return (True, True, group, key)
+            return (key == newest[file_id[ARTIST]], bool(file_id['processCP']), key, key)
+
+        return sorted(files, key=priority, reverse=True)
+
+    def register(self, files):
+        """ inscrit la liste ordonnée des fichiers à traiter dans le journal de reprise """
+        if self.journal is None:
+            return files
+        return self.journal.register(files)
+
+    @staticmethod
+    def files_signature():
+        """ empreinte des paramètres décidant du traitement d'un fichier, un fichier indexé n'est valable que pour eux """
+        params = [sorted(bot.RBProgs.items()), settings.audioSignature, settings.autoCorrectFilename,
+                  settings.currentPath, settings.makeDistCopy]
+        return hashlib.sha1(json.dumps(params, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def report_deferred(self):
+        """ liste en fin de traitement les fichiers non traités faute de temps """
+        if self.budget is None or not self.budget.deferred:
+            return
+        self.info(STARS)
+        self.info(f"{len(self.budget.deferred)} fichier(s) reporté(s) au prochain traitement, temps alloué écoulé :")
+        for file_id in self.budget.deferred:
+            self.info(f"    {file_id[RELPATH]}{file_id[FILENAME]}")
+        self.detail(STARS)
+
 
     def scan(self):
     ### need to checl params in dirscan    
+        if self.index is not None:
+            self.index.check_files(self.files_signature())
+        if self.journal is not None and self.journal.files:
+            return JournalScan(self.journal)
         if settings.scanDirectory:
+            if settings.scanStream:
+                return DirScan(settings.streamWindow)
+            if settings.changeLimit > 0:
+                # seuls les meilleurs candidats sont gardés en mémoire, les suivants sont cherchés si nécessaire
+                return DirScan(select_limit = max(settings.changeLimit * SELECT_MARGIN, SELECT_MIN))
             return DirScan()
         else:
             if os.path.exists(settings.syncPath):
                 if os.path.isdir(settings.syncPath):
+                    if settings.syncCursor:
+                        # lecture de tous les logs non encore lus, à partir de la position atteinte
+                        return FileScan(settings.syncPath, SyncCursor(settings.syncCursor))
                     file = settings.syncPath + self.getLastFile(settings.syncPath, settings.syncSignature)
                 else:
                     file = settings.syncPath
@@ -396,13 +1275,176 @@ class Engine(Logger):
                     self.detail(f"{file} : OK")
                     break
                 else:
-                    self.verbose("Fichier pas OK "+ file)
+                    self.verbose("Fichier pas OK %s", file)
             return selected
         else:
             self.error("Le répertoire des logs différentiels Vide")
             return None
 
 
+class HeaderTags(dict):
+    """ Tags ID3v2 et durée lus directement dans les en-têtes du fichier MP3, sans analyse complète par mutagen.
+
+        Expose la même interface minimale que l'objet mutagen utilisé pour la vérification :
+        tags[clé][0] et info.length. read() retourne None dès que la lecture est ambiguë,
+        le fichier est alors analysé par mutagen.
+    """
+
+    def __init__(self, tags, length, tag_size):
+        super().__init__(tags)
+        self.info = SimpleNamespace(length=length)
+        self.tag_size = tag_size
+
+    @classmethod
+    def read(cls, full_pathname):
+        try:
+            with open(full_pathname, 'rb') as source:
+                header = source.read(10)
+                if len(header) != 10 or header[:3] != b'ID3' or header[3] not in (3, 4) or header[5] & 0xD0:
+                    # pas d'ID3v2, ID3v2.2, désynchronisation, en-tête étendu ou pied de tag
+                    return None
+                size = cls.syncsafe(header[6:10])
+                if size is None:
+                    return None
+                tags = cls.read_frames(source.read(size), header[3])
+                if tags is None:
+                    return None
+                tag_size = size + 10
+                frames = source.read(MPEG_PROBE_SIZE)
+                file_size = os.fstat(source.fileno()).st_size
+        except OSError:
+            return None
+        length = cls.read_length(frames, file_size - tag_size)
+        if length is None:
+            return None
+        return cls(tags, length, tag_size)
+
+    @staticmethod
+    def syncsafe(data):
+        if any(byte & 0x80 for byte in data):
+            return None
+        return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+    @classmethod
+    def read_frames(cls, data, version):
+        """ retourne les valeurs des tags vérifiés, None si un tag manque ou n'est pas lisible simplement """
+        tags = {}
+        position = 0
+        while position + 10 <= len(data) and data[position] != 0:
+            frame_id = data[position:position + 4].decode('latin-1')
+            if version == 4:
+                size = cls.syncsafe(data[position + 4:position + 8])
+                if size is None:
+                    return None
+                flags_mask = 0x4F  # groupement, compression, chiffrement, désynchronisation, longueur
+            else:
+                size = int.from_bytes(data[position + 4:position + 8], 'big')
+                flags_mask = 0xE0  # compression, chiffrement, groupement
+            body = data[position + 10:position + 10 + size]
+            position += 10 + size
+            if frame_id in ID3_DATE_CONFLICTS[version]:
+                # date recomposée par mutagen à partir de plusieurs tags
+                return None
+            key = ID3_FRAMES[version].get(frame_id)
+            if key is None:
+                continue
+            if key in tags or len(body) != size or data[position - size - 1] & flags_mask:
+                return None
+            values = cls.decode_text(body)
+            if not values:
+                return None
+            tags[key] = values
+        if any(key not in tags for key in ID3_FRAMES[version].values()):
+            # un tag absent peut être complété par mutagen depuis un tag ID3v1
+            return None
+        if not ID3_DATE.match(tags[YEAR][0]):
+            return None
+        return tags
+
+    @staticmethod
+    def decode_text(body):
+        if not body or body[0] not in ID3_ENCODINGS:
+            return None
+        encoding, separator = ID3_ENCODINGS[body[0]]
+        data = body[1:]
+        if len(separator) == 2:
+            # terminateur UTF-16 aligné sur 2 octets
+            chunks, start = [], 0
+            for i in range(0, len(data) - 1, 2):
+                if data[i:i + 2] == separator:
+                    chunks.append(data[start:i])
+                    start = i + 2
+            chunks.append(data[start:])
+        else:
+            chunks = data.split(separator)
+        if len(chunks) > 1 and not chunks[-1]:
+            chunks.pop()
+        try:
+            if encoding == 'utf-16' and any(chunk[:2] not in (b'\xff\xfe', b'\xfe\xff') for chunk in chunks):
+                return None
+            return [chunk.decode(encoding) for chunk in chunks]
+        except UnicodeDecodeError:
+            return None
+
+    @classmethod
+    def read_length(cls, frames, content_size):
+        """ durée d'après l'en-tête Xing/Info ou VBRI de la première trame, ou d'après le débit si 4 trames CBR se suivent """
+        first = cls.mpeg_frame(frames, 0)
+        if first is None:
+            return None
+        version, mono, bitrate, sample_rate, frame_length = first
+        samples = 1152 if version == 1 else 576
+        xing = 4 + (17 if mono else 32) if version == 1 else 4 + (9 if mono else 17)
+        if frames[xing:xing + 4] in (b'Xing', b'Info'):
+            return cls.xing_length(frames, xing, samples, sample_rate)
+        if frames[36:40] == b'VBRI':
+            if len(frames) < 54:
+                return None
+            return float(samples * int.from_bytes(frames[50:54], 'big')) / sample_rate
+        position = frame_length
+        for _ in range(3):
+            following = cls.mpeg_frame(frames, position)
+            if following is None:
+                return None
+            position += following[4]
+        return 8 * content_size / float(bitrate)
+
+    @staticmethod
+    def xing_length(frames, xing, samples, sample_rate):
+        flags = int.from_bytes(frames[xing + 4:xing + 8], 'big')
+        if not flags & 0x1:
+            return None
+        count = int.from_bytes(frames[xing + 8:xing + 12], 'big')
+        lame = xing + 12 + (4 if flags & 0x2 else 0) + (100 if flags & 0x4 else 0) + (4 if flags & 0x8 else 0)
+        if len(frames) < lame + 36:
+            return None
+        length = float(samples * count) / sample_rate
+        if frames[lame:lame + 4] in (b'LAME', b'L3.9'):
+            # mutagen retire le délai et le remplissage de l'encodeur suivant la version de LAME :
+            # la lecture rapide n'est retenue que si le résultat affiché est le même dans les deux cas
+            delay = frames[lame + 21:lame + 24]
+            trimmed = samples * count - ((delay[0] << 4) | (delay[1] >> 4)) - (((delay[1] & 0xF) << 8) | delay[2])
+            if format_lasting(max(trimmed, 0) / sample_rate) != format_lasting(length):
+                return None
+        return length
+
+    @staticmethod
+    def mpeg_frame(frames, position):
+        """ retourne version, mono, débit, fréquence et longueur d'une trame MPEG layer III valide, None sinon """
+        header = frames[position:position + 4]
+        if len(header) != 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+            return None
+        version = MPEG_VERSIONS[(header[1] >> 3) & 0x3]
+        bitrate_index = header[2] >> 4
+        rate_index = (header[2] >> 2) & 0x3
+        if version is None or (header[1] >> 1) & 0x3 != 1 or bitrate_index in (0, 15) or rate_index == 3:
+            return None
+        bitrate = MPEG_BITRATES[version == 1][bitrate_index] * 1000
+        sample_rate = MPEG_RATES[version][rate_index]
+        frame_length = (1152 if version == 1 else 576) // 8 * bitrate // sample_rate + ((header[2] >> 1) & 0x1)
+        return version, header[3] >> 6 == 3, bitrate, sample_rate, frame_length
+
+
 class TagsModel(list):
     """ Classe permettant d'accéder aux fonctions de mutagen. """
 
@@ -416,6 +1458,10 @@ class TagsModel(list):
         self.calcTags = calc_tags
         
 
+    def detached(self):
+        """ copie indépendante des tags calculés, pour une écriture en arrière-plan sur la racine distante """
+        return TagsModel(self.model, self.root, dict(self.calcTags))
+
     def loadSet(self, full_pathname=''):
         self.relpath, filename = split_filepath(full_pathname)
         self.calcTags[RELPATH] = RELPATH
@@ -424,11 +1470,11 @@ class TagsModel(list):
         self.hasFile = True
 
     def loadPhyTags(self, full_pathname):
-        try:
-            self.fileTags = MP3(full_pathname, ID3=EasyID3)
-        except MutagenError:
-            self.fileTags = mutagen.File(full_pathname, easy=True)
-            self.fileTags.add_tags()
+        self.full_pathname = full_pathname
+        with bot.metrics.stage(STAGE_TAG_PARSE):
+            self.fileTags = HeaderTags.read(full_pathname) if settings.fastTagRead else None
+            if self.fileTags is None:
+                self.fileTags = self.loadFullTags(full_pathname)
         if self.model == SOURCE:
             self.calcTags[LENGTH]= format_lasting(self.fileTags.info.length)
         else:
@@ -438,11 +1484,19 @@ class TagsModel(list):
             self.calcTags[MODEL] = self.model
             raw_title = self.fileTags[TITLE][0]    
             for key in [LENGTH, YEAR, MODEL, SHORT_MODEL, TRACK]:
-                find = (r'\s?' + self.getCalcTag(key, make_milter=True) + r'\s?-?')
-                raw_title = re.sub(find,'', raw_title, re.I)
+                # seule la première occurrence est retirée : « Episode 129 » garde son numéro en piste 29
+                raw_title = settings.patterns.title_part(self.getCalcTag(key, make_filter=True)).sub('', raw_title, count=1)
             self.calcTags[RAW_TITLE] = raw_title
         return True
 
+    def loadFullTags(self, full_pathname):
+        try:
+            file_tags = MP3(full_pathname, ID3=EasyID3)
+        except MutagenError:
+            file_tags = mutagen.File(full_pathname, easy=True)
+            file_tags.add_tags()
+        return file_tags
+
     def strID(self, calc = False):
         if calc:
             return " ".join( ALL_KEYS[key][0] + self.getCalcTag(key) for key in READ_FILE_KEYS )    
@@ -454,15 +1508,15 @@ class TagsModel(list):
         
     
     @format_field
-    def getCalcTag(self, key, model=None, make_milter=False):
+    def getCalcTag(self, key, model=None, make_filter=False):
         """ retourne la valeur calculée et formaté d'une clé de tag"""
         if not model:
             model = self.model
         self.calcTags[MODEL] = model
-        self.calcTags[SHORT_MODEL] = PHY_MODELS[model]
+        self.calcTags[SHORT_MODEL] = short_model(model)
 
         if key == TITLE:
-            return '-'.join( self.getCalcTag(x, model) for x in TITLE_SUM_KEYS[model] if self.getCalcTag(x, model) not in EXCLUDE_FROM_TITLE)
+            return '-'.join( self.getCalcTag(x, model) for x in TITLE_SUM_KEYS[base_model(model)] if self.getCalcTag(x, model) not in EXCLUDE_FROM_TITLE)
         else:
             return self.calcTags[key]
 
@@ -485,19 +1539,733 @@ class TagsModel(list):
     def save(self, model=None):
         if not model:
             model = self.model
+        if isinstance(self.fileTags, HeaderTags):
+            # tags lus en lecture rapide : mutagen n'est chargé que pour l'écriture
+            self.fileTags = self.loadFullTags(self.full_pathname)
    
         for key in SAVE_FILE_KEYS :
                 self.fileTags[key] = self.getCalcTag(key, model) 
-        self.fileTags.save()
+        full_pathname = self.fileTags.filename
+        if bot.io.enabled:
+            # écriture sur place : tout le bloc ID3 existant est réécrit
+            bot.io.acquire(file_tag_size(full_pathname))
+        with bot.metrics.stage(STAGE_TAG_SAVE):
+            try:
+                self.fileTags.save(padding=self.keep_padding)
+            except BTTagOverflow:
+                self.rewriteTags(full_pathname)
+                in_place = False
+            else:
+                in_place = True
+        bot.dircache.written(full_pathname)
+        if in_place:
+            bot.detail("Tags écrits sur place dans %s", full_pathname)
+        else:
+            bot.detail("Tags écrits avec réécriture complète du fichier %s", full_pathname)
+
+    def keep_padding(self, info):
+        """ conserve la taille du bloc ID3 existant quand les nouveaux tags y tiennent, sinon interdit l'écriture sur place """
+        if info.padding >= 0:
+            return info.padding
+        raise BTTagOverflow(self.fileTags.filename)
+
+    def rewriteTags(self, full_pathname):
+        """ réécrit le fichier avec un bloc ID3 assez grand pour les corrections suivantes
+            le fichier est reconstruit à côté puis renommé, il n'est jamais laissé à moitié écrit
+            mutagen n'écrit que les tags dans un fichier vide, le contenu audio est recopié par blocs soumis au limiteur """
+        temp_file = full_pathname + COPY_PARTIAL_EXT
+        try:
+            with open(full_pathname, 'rb') as source:
+                tag_size = id3_tag_size(source.read(10))
+                size = os.fstat(source.fileno()).st_size
+                source.seek(max(size - ID3V1_SIZE, 0))
+                has_v1 = source.read(3) == b'TAG'
+            audio_size = size - tag_size - (ID3V1_SIZE if has_v1 else 0)
+            open(temp_file, 'wb').close()
+            bot.io.acquire(settings.tagPadding, 0)
+            # v1=2 : le tag ID3v1 mis à jour est écrit après le bloc ID3v2, il est replacé en fin de fichier
+            self.fileTags.save(temp_file, v1=2 if has_v1 else 1, padding=lambda info : settings.tagPadding)
+            with open(full_pathname, 'rb') as source, open(temp_file, 'r+b') as dest:
+                dest_offset = os.fstat(dest.fileno()).st_size
+                v1_tag = b''
+                if has_v1:
+                    dest_offset -= ID3V1_SIZE
+                    dest.seek(dest_offset)
+                    v1_tag = dest.read(ID3V1_SIZE)
+                    dest.truncate(dest_offset)
+                if copy_content(source, dest, audio_size, tag_size, dest_offset) != audio_size:
+                    raise OSError(f'contenu audio incomplet dans {temp_file}')
+                dest.seek(dest_offset + audio_size)
+                dest.write(v1_tag)
+            shutil.copymode(full_pathname, temp_file)
+            bot.io.acquire()
+            os.replace(temp_file, full_pathname)
+        except (OSError, MutagenError, BTCopyError):
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            raise
+
+
+class TokenBucket():
+    """ seau à jetons : se remplit au débit rate et contient au plus une seconde de débit, rate 0 : pas de limite """
+
+    __slots__ = ('rate', 'tokens', 'stamp')
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.stamp = time.monotonic()
+
+    def take(self, amount):
+        """ prélève amount jetons, retourne l'attente nécessaire en secondes (le seau peut devenir débiteur) """
+        if not self.rate:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.stamp) * self.rate) - amount
+        self.stamp = now
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def debt(self):
+        """ attente encore due aux prélèvements déjà faits, en secondes, sans rien prélever """
+        if not self.rate:
+            return 0.0
+        tokens = min(self.rate, self.tokens + (time.monotonic() - self.stamp) * self.rate)
+        return -tokens / self.rate if tokens < 0 else 0.0
+
+
+class IOScheduler():
+    """ Limiteur des copies et renommages de fichiers audio : débit en octets/s et nombre d'opérations/s
+
+        Deux profils de limites, à l'antenne et hors antenne, choisis d'après les plages horaires d'antenne.
+        Les attentes sont réservées sous verrou puis faites hors verrou : les threads se partagent le débit.
+        Sans limite (profils à 0), acquire() retourne immédiatement.
+    """
+
+    def __init__(self, profiles=None, on_air_hours=()):
+        self.profiles = profiles or {True : (0, 0), False : (0, 0)}
+        self.on_air_hours = list(on_air_hours)
+        self.enabled = any(any(rates) for rates in self.profiles.values())
+        self.on_air = None
+        self.buckets = None
+        self.waited = 0.0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def parse_hours(values):
+        """ plages HH:MM-HH:MM en minutes depuis minuit, une plage peut passer minuit """
+        hours = []
+        for value in values:
+            if not value.strip():
+                continue
+            match = IO_HOURS.match(value.strip())
+            start_h, start_m, end_h, end_m = (int(part) for part in match.groups()) if match else (99, 0, 0, 0)
+            if max(start_h, end_h) > 23 or max(start_m, end_m) > 59:
+                raise BTException(f"Plage horaire d'antenne incorrecte : {value} (format HH:MM-HH:MM)")
+            hours.append((start_h * 60 + start_m, end_h * 60 + end_m))
+        return hours
+
+    def is_on_air(self, now):
+        minutes = now.hour * 60 + now.minute
+        for start, end in self.on_air_hours:
+            if (start <= minutes < end) if start <= end else (minutes >= start or minutes < end):
+                return True
+        return False
+
+    def current_buckets(self):
+        on_air = self.is_on_air(datetime.now())
+        if on_air != self.on_air:
+            self.on_air = on_air
+            self.buckets = [TokenBucket(rate) for rate in self.profiles[on_air]]
+            rate, ops = self.profiles[on_air]
+            bot.detail(f"Profil d'entrées/sorties {'antenne' if on_air else 'hors antenne'} : "
+                       f"{rate // 1024 if rate else 'sans limite'} Ko/s, {ops or 'sans limite'} opérations/s")
+        return self.buckets
+
+    def chunk_size(self):
+        """ taille des blocs de copie quand le débit est limité, None sinon """
+        if not self.enabled:
+            return None
+        with self.lock:
+            rate = self.current_buckets()[0].rate
+        return max(IO_MIN_CHUNK_SIZE, min(COPY_CHUNK_SIZE, rate // 4)) if rate else None
+
+    def acquire(self, size=0, ops=1):
+        """ attend que le profil en cours permette ops opérations et size octets """
+        if not self.enabled:
+            return
+        with self.lock:
+            bytes_bucket, ops_bucket = self.current_buckets()
+            delay = max(bytes_bucket.take(size), ops_bucket.take(ops))
+            self.waited += delay
+        if delay > 0:
+            time.sleep(delay)
+
+    def backlog(self):
+        """ attente imposée à la prochaine opération par celles déjà réservées (autres threads), en secondes """
+        if not self.enabled:
+            return 0.0
+        with self.lock:
+            if self.buckets is None:
+                return 0.0
+            return max(bucket.debt() for bucket in self.buckets)
+
+
+class DistantQueue():
+    """ File ordonnée des opérations sur la racine distante, exécutées par un thread pendant que le traitement local continue
+
+        Les opérations sont exécutées une à une dans l'ordre de leur dépôt : les rotations current/previous distantes
+        restent dans le même ordre qu'en local. Elles relisent les fichiers locaux : wait() permet d'attendre
+        la fin des opérations d'un artiste avant de modifier à nouveau ses fichiers locaux. Le volume des opérations
+        en attente est plafonné à max_bytes, au-delà le dépôt attend.
+        barrier() attend la fin de toutes les opérations et retourne celles en échec avec le fichier concerné.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self.count = 0
+        self.pending = {}
+        self.failures = []
+        self.failed = set()
+        self.condition = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='distant')
+
+    def submit(self, file_id, description, size, operation, *args):
+        key = file_id[ARTIST]
+        with self.condition:
+            while self.in_flight and self.in_flight + size > self.max_bytes:
+                self.condition.wait()
+            self.in_flight += size
+            self.count += 1
+            self.pending[key] = self.pending.get(key, 0) + 1
+        self.executor.submit(self.run, file_id, description, size, operation, args)
+
+    def then(self, file_id, operation, *args):
+        """ exécute operation après les opérations déjà déposées (index d'un fichier), sans la compter comme opération distante """
+        key = file_id[ARTIST]
+        with self.condition:
+            self.pending[key] = self.pending.get(key, 0) + 1
+        self.executor.submit(self.run, file_id, "Enregistrement dans l'index", 0, operation, args)
+
+    def run(self, file_id, description, size, operation, args):
+        try:
+            operation(*args)
+        except Exception as e:
+            with self.condition:
+                self.failures.append((file_id, description, e))
+                self.failed.add((file_id[RELPATH], file_id[FILENAME]))
+        finally:
+            with self.condition:
+                self.in_flight -= size
+                self.pending[file_id[ARTIST]] -= 1
+                self.condition.notify_all()
+
+    def has_failed(self, file_id):
+        with self.condition:
+            return (file_id[RELPATH], file_id[FILENAME]) in self.failed
+
+    def wait(self, key):
+        with self.condition:
+            while self.pending.get(key):
+                self.condition.wait()
+
+    def barrier(self):
+        self.executor.shutdown(wait=True)
+        return self.failures
+
+
+class DirCache():
+    """ Contenu des répertoires des racines local et distant, lu une seule fois par os.scandir
+
+        Les tests d'existence et de taille des fichiers audio sont servis depuis la mémoire : sur un partage réseau
+        chaque os.stat est un aller-retour. Les copies, déplacements et écritures de botag tiennent le cache à jour,
+        la taille d'un fichier écrit est relue à la demande. Désactivé, chaque test interroge le disque.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.dirs = {}
+        self.lock = threading.Lock()
+
+    def entries(self, directory):
+        """ retourne le contenu du répertoire (nom -> DirEntry, stat ou None si à relire), None s'il est illisible """
+        key = os.path.normcase(directory)
+        entries = self.dirs.get(key)
+        if entries is None:
+            try:
+                with os.scandir(directory) as listing:
+                    entries = {os.path.normcase(entry.name) : entry for entry in listing}
+            except (FileNotFoundError, NotADirectoryError):
+                entries = {}
+            except OSError:
+                return None
+            with self.lock:
+                entries = self.dirs.setdefault(key, entries)
+        return entries
+
+    def lookup(self, path):
+        directory, name = os.path.split(path)
+        return self.entries(directory), os.path.normcase(name)
+
+    def exists(self, path):
+        if not self.enabled:
+            return os.path.exists(path)
+        entries, name = self.lookup(path)
+        if entries is None:
+            return os.path.exists(path)
+        return name in entries
+
+    def getsize(self, path):
+        if not self.enabled:
+            return os.path.getsize(path)
+        entries, name = self.lookup(path)
+        if entries is None:
+            return os.path.getsize(path)
+        if name not in entries:
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        entry = entries[name]
+        if entry is None:
+            # fichier écrit par botag depuis la lecture du répertoire
+            entry = entries[name] = os.stat(path)
+        elif isinstance(entry, os.DirEntry):
+            return entry.stat().st_size
+        return entry.st_size
+
+    def update(self, path, present):
+        if not self.enabled:
+            return
+        directory, name = os.path.split(path)
+        with self.lock:
+            entries = self.dirs.get(os.path.normcase(directory))
+            # répertoire pas encore lu : il le sera à jour
+            if entries is not None:
+                if present:
+                    entries[os.path.normcase(name)] = None
+                else:
+                    entries.pop(os.path.normcase(name), None)
+
+    def written(self, path):
+        self.update(path, True)
+
+    def moved(self, source_file, dest_file):
+        self.update(source_file, False)
+        self.update(dest_file, True)
+
+
+class ScanIndex():
+    """ Index persistant (SQLite) des fichiers audio déjà vérifiés.
+
+        Chaque fichier est identifié par son chemin relatif, sa taille et sa date de modification.
+        Un fichier dont l'empreinte n'a pas changé depuis sa dernière vérification n'est plus analysé.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+        self.pending = 0
+        self.lock = threading.Lock()
+        # fichiers vérifiés sans erreur pendant ce traitement par répertoire, et répertoires ayant un fichier en erreur
+        self.verified = {}
+        self.failed = set()
+
+    def open(self):
+        try:
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute("""CREATE TABLE IF NOT EXISTS files (
+                                relpath TEXT NOT NULL, filename TEXT NOT NULL,
+                                size INTEGER, mtime INTEGER,
+                                artist TEXT, year TEXT, track TEXT, rawtitle TEXT,
+                                tags TEXT, cpstate TEXT, checked TEXT,
+                                PRIMARY KEY (relpath, filename))""")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS dirs (
+                                relpath TEXT PRIMARY KEY, mtime INTEGER, entries INTEGER, subdirs TEXT)""")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS params (
+                                name TEXT PRIMARY KEY, value TEXT)""")
+        except sqlite3.Error as e:
+            raise BTException(f"Ouverture impossible de l'index {self.path}\nDétail : {e}")
+        bot.detail(f"Index des fichiers vérifiés : {self.path}")
+
+    def close(self):
+        if self.db is not None:
+            self.db.commit()
+            self.db.close()
+            self.db = None
+
+    @staticmethod
+    def fingerprint(full_pathname):
+        """ retourne le couple taille/date de modification du fichier, None si inaccessible """
+        try:
+            stat = os.stat(full_pathname)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def is_unchanged(self, relpath, filename, full_pathname, fingerprint=None):
+        if fingerprint is None:
+            fingerprint = self.fingerprint(full_pathname)
+        if fingerprint is None:
+            return False
+        row = self.query("SELECT size, mtime FROM files WHERE relpath=? AND filename=?", (relpath, filename))
+        return row is not None and tuple(row) == fingerprint
+
+    def update(self, audio, full_pathname):
+        """ enregistre l'état vérifié d'un fichier audio """
+        fingerprint = self.fingerprint(full_pathname)
+        if fingerprint is None:
+            return
+        tags = audio.models[SOURCE]
+        self.write("INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+                   (audio.relative_path, audio.filename, fingerprint[0], fingerprint[1],
+                    tags.calcTags[ARTIST], tags.calcTags[YEAR], tags.calcTags[TRACK], tags.calcTags[RAW_TITLE],
+                    tags.strID(), audio.cp_state, datetime.now().isoformat(timespec='seconds')))
+        with self.lock:
+            self.verified[audio.relative_path] = self.verified.get(audio.relative_path, 0) + 1
+
+    def remove(self, relpath, filename):
+        self.write("DELETE FROM files WHERE relpath=? AND filename=?", (relpath, filename))
+        with self.lock:
+            self.failed.add(relpath)
+
+    def is_verified(self, relpath, count):
+        """ vrai si les count fichiers sélectionnés d'un répertoire ont tous été vérifiés sans erreur pendant ce traitement """
+        with self.lock:
+            return relpath not in self.failed and self.verified.get(relpath, 0) >= count
+
+    def get_dir(self, relpath):
+        """ retourne date de modification, nombre d'entrées et sous-répertoires mémorisés d'un répertoire """
+        row = self.query("SELECT mtime, entries, subdirs FROM dirs WHERE relpath=?", (relpath,))
+        if row is None:
+            return None
+        return row[0], row[1], row[2].split('/') if row[2] else []
+
+    def set_dir(self, relpath, mtime, entries, subdirs):
+        self.write("INSERT OR REPLACE INTO dirs VALUES (?,?,?,?)", (relpath, mtime, entries, '/'.join(subdirs)))
+
+    def check_dirs(self, signature):
+        """ les répertoires mémorisés ne valent que pour la liste des émissions et les filtres qui les ont sélectionnés :
+            si la signature de ces paramètres a changé, ils sont tous oubliés """
+        row = self.query("SELECT value FROM params WHERE name='dirs'", ())
+        if row is not None and row[0] == signature:
+            return
+        if row is not None:
+            bot.info("Liste des émissions ou filtres modifiés : répertoires inchangés oubliés, analyse complète")
+        self.write("DELETE FROM dirs", ())
+        self.write("INSERT OR REPLACE INTO params VALUES ('dirs', ?)", (signature,))
+
+    def check_files(self, signature):
+        """ un fichier vérifié ne l'est que pour la liste des émissions (current/previous, nombre d'épisodes, nom d'artiste)
+            et les paramètres de traitement de sa vérification : si leur signature a changé, tous les fichiers sont à revérifier
+            et les répertoires mémorisés, qui supposent leurs fichiers vérifiés, sont oubliés """
+        row = self.query("SELECT value FROM params WHERE name='files'", ())
+        if row is not None and row[0] == signature:
+            return
+        if row is not None:
+            bot.info("Liste des émissions ou paramètres de traitement modifiés : tous les fichiers seront vérifiés à nouveau")
+        self.write("DELETE FROM files", ())
+        self.write("DELETE FROM dirs", ())
+        self.write("INSERT OR REPLACE INTO params VALUES ('files', ?)", (signature,))
+
+    def query(self, sql, params):
+        with self.lock:
+            return self.db.execute(sql, params).fetchone()
+
+    def write(self, sql, params):
+        with self.lock:
+            self.db.execute(sql, params)
+            # les écritures sont regroupées pour ne pas synchroniser le disque à chaque fichier
+            self.pending += 1
+            if self.pending >= INDEX_COMMIT_EVERY:
+                self.db.commit()
+                self.pending = 0
+
+
+class SyncCursor():
+    """ Position de lecture atteinte dans chaque log de synchronisation, conservée d'une exécution à l'autre """
+
+    def __init__(self, path):
+        self.path = path
+        self.offsets = None
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as source:
+                self.offsets = json.load(source)
+        except FileNotFoundError:
+            self.offsets = None
+        except (OSError, ValueError) as e:
+            raise BTException(f"Lecture impossible du curseur des logs {self.path}\nDétail : {e}")
+
+    def save(self):
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as target:
+                json.dump(self.offsets, target, indent=1)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            bot.error(f"Enregistrement impossible du curseur des logs {self.path}\nDétail : {e}")
+        else:
+            bot.detail(f"Curseur des logs enregistré : {self.path}")
+
+    def pending(self, directory, signature):
+        """ retourne la liste ordonnée (nom, position) des logs ayant des lignes non lues
+            à la première utilisation, seul le log le plus récent est lu et les autres sont considérés comme lus """
+        logs = {}
+        for filename in os.listdir(directory):
+            if re.search(signature, filename, re.IGNORECASE):
+                stat = os.stat(directory + filename)
+                logs[filename] = (stat.st_mtime_ns, stat.st_size)
+        # du plus ancien au plus récent d'après la date de modification
+        logs = {filename : size for filename, (mtime, size) in sorted(logs.items(), key=lambda item : (item[1][0], item[0]))}
+        if self.offsets is None:
+            newest = next(reversed(logs), None)
+            self.offsets = {filename : size for filename, size in logs.items() if filename != newest}
+        # les logs supprimés par la rotation sont oubliés
+        self.offsets = {filename : offset for filename, offset in self.offsets.items() if filename in logs}
+        pending = []
+        for filename, size in logs.items():
+            offset = self.offsets.get(filename, 0)
+            if offset > size:
+                # log réécrit depuis la dernière lecture
+                offset = 0
+            if offset < size:
+                pending.append((filename, offset))
+        return pending
+
+    def advance(self, filename, offset):
+        self.offsets[filename] = offset
+
+
+class Journal():
+    """ Journal de reprise d'un traitement interrompu (limite de changements, temps alloué ou arrêt brutal)
+
+        Fichier JSON d'un événement par ligne, complété au fil du traitement : liste ordonnée des candidats,
+        fichiers terminés et état de chaque copie/déplacement des fichiers audio (rotation current/previous, renommage).
+        Au lancement suivant les opérations interrompues sont réparées et le traitement reprend
+        aux fichiers non terminés, sans nouvelle analyse. Le journal est supprimé quand tout est terminé.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        self.steps = {}
+        self.next_position = 0
+        self.target = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def params():
+        """ paramètres de sélection : un journal créé avec d'autres paramètres n'est pas repris """
+        return {'root' : settings.root, 'currentPath' : settings.currentPath, 'scanDirectory' : settings.scanDirectory,
+                'syncPath' : settings.syncPath, 'scanAudioFilter' : settings.scanAudioFilter, 'scanPathFilter' : settings.scanPathFilter}
+
+    def open(self):
+        if os.path.exists(self.path):
+            self.load()
+        if self.steps:
+            self.repair()
+        if self.files:
+            bot.info(f"Reprise du traitement interrompu : {len(self.files)} fichier(s) restant(s) à partir de la position {min(self.files)}")
+        # le journal est réécrit sans les fichiers terminés
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as target:
+                target.write(json.dumps({'journal' : JOURNAL_VERSION, 'params' : self.params()}, ensure_ascii=False) + '\n')
+                if self.files:
+                    target.write(json.dumps({'files' : self.pending()}, ensure_ascii=False) + '\n')
+            os.replace(temp_path, self.path)
+            self.target = open(self.path, 'a', encoding='utf-8')
+        except OSError as e:
+            raise BTException(f"Ouverture impossible du journal {self.path}\nDétail : {e}")
+        bot.detail(f"Journal de reprise : {self.path}")
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as source:
+                lines = source.read().splitlines()
+        except OSError as e:
+            raise BTException(f"Lecture impossible du journal {self.path}\nDétail : {e}")
+        events = []
+        for line in lines:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                # dernière ligne incomplète : arrêt pendant l'écriture
+                break
+        if not events or events[0].get('journal') != JOURNAL_VERSION or events[0].get('params') != self.params():
+            bot.warning(f"Journal {self.path} créé avec d'autres paramètres : non repris")
+            return
+        for event in events[1:]:
+            if 'files' in event:
+                for file_id in event['files']:
+                    self.files[file_id[JOURNAL_POS]] = file_id
+                    self.next_position = max(self.next_position, file_id[JOURNAL_POS] + 1)
+            elif 'done' in event:
+                self.files.pop(event['done'], None)
+            elif 'step' in event:
+                self.steps[tuple(event['step'])] = event
+
+    def repair(self):
+        """ termine ou annule les copies/déplacements interrompus, le fichier concerné est ensuite traité à nouveau """
+        for key in sorted(self.steps):
+            step = self.steps[key]
+            if step['state'] == STEP_DONE:
+                continue
+            bot.warning(f"Opération interrompue ({step['op']} {step['from']} vers {step['to']}, état {step['state']}) : réparation")
+            try:
+                self.repair_step(step)
+            except OSError as e:
+                bot.error(f"Réparation impossible de {step['to']}\nDétail : {e}")
+        self.steps.clear()
+
+    def repair_step(self, step):
+        local_from, local_to = settings.root[LOCAL] + step['from'], settings.root[LOCAL] + step['to']
+        state = step['state']
+        if step['op'] == JOURNAL_COPY and state == STEP_COPIED:
+            # copie locale sans ses tags : supprimée pour être refaite
+            if os.path.exists(local_to):
+                os.remove(local_to)
+            return
+        if step['op'] == JOURNAL_MOVE and state == STEP_TAGGED and os.path.exists(local_from):
+            # tags déjà écrits : seul le renommage local manque
+            os.replace(local_from, local_to)
+            state = STEP_LOCAL
+        if state == STEP_LOCAL and settings.makeDistCopy:
+            # le distant est aligné sur le local pour les fichiers touchés par l'opération
+            for relpath in [step['to']] + ([step['from']] if step['op'] == JOURNAL_MOVE else []):
+                local_file, dist_file = settings.root[LOCAL] + relpath, settings.root[DISTANT] + relpath
+                if os.path.exists(local_file):
+                    copy_file(local_file, dist_file)
+                elif os.path.exists(dist_file):
+                    os.remove(dist_file)
+
+    def close(self):
+        if self.target is not None:
+            self.target.close()
+            self.target = None
+        if self.files or any(step['state'] != STEP_DONE for step in self.steps.values()):
+            bot.info(f"Journal de reprise conservé : {len(self.files)} fichier(s) restant(s) au prochain lancement")
+            return
+        try:
+            os.remove(self.path)
+        except OSError as e:
+            bot.warning(f"Suppression impossible du journal terminé {self.path}\nDétail : {e}")
+        else:
+            bot.detail("Journal de reprise terminé et supprimé")
+
+    def write(self, event):
+        with self.lock:
+            self.target.write(json.dumps(event, ensure_ascii=False) + '\n')
+            self.target.flush()
+
+    def pending(self):
+        return [self.files[position] for position in sorted(self.files)]
+
+    def register(self, files):
+        """ numérote dans l'ordre de traitement les fichiers pas encore journalisés """
+        new_files = [file_id for file_id in files if JOURNAL_POS not in file_id]
+        if new_files:
+            with self.lock:
+                for file_id in new_files:
+                    file_id[JOURNAL_POS] = self.next_position
+                    self.files[self.next_position] = file_id
+                    self.next_position += 1
+            self.write({'files' : new_files})
+        return files
+
+    def done(self, file_id):
+        position = file_id.get(JOURNAL_POS)
+        if position is not None:
+            with self.lock:
+                self.files.pop(position, None)
+            self.write({'done' : position})
+
+    def step(self, audio, op, source_file, dest_file):
+        root_length = len(settings.root[LOCAL])
+        audio.journal_steps += 1
+        event = {'step' : [audio.journal_pos, audio.journal_steps], 'op' : op,
+                 'from' : source_file[root_length:], 'to' : dest_file[root_length:], 'state' : STEP_START}
+        self.steps[tuple(event['step'])] = event
+        self.write(event)
+        return JournalStep(self, event)
+
+
+class JournalStep():
+    """ état d'une copie/déplacement dans le journal, sans effet si le journal n'est pas utilisé """
+
+    __slots__ = ('journal', 'event')
+
+    def __init__(self, journal=None, event=None):
+        self.journal = journal
+        self.event = event
+
+    def state(self, state):
+        if self.journal is not None:
+            self.event['state'] = state
+            self.journal.write(self.event)
+            if state == STEP_DONE:
+                self.journal.steps.pop(tuple(self.event['step']), None)
+
+
+class JournalScan():
+    """ reprise d'un traitement interrompu : les fichiers restants du journal, dans leur ordre, sans nouvelle analyse """
+
+    def __init__(self, journal):
+        self.journal = journal
+
+    def __enter__(self):
+        files = self.journal.pending()
+        bot.info(STARS)
+        bot.info(f'Reprise depuis le journal {self.journal.path} : pas de nouvelle analyse')
+        bot.scan_count = len(files)
+        return ScanBatch(files)
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        pass
+
+
+class NewestFirst():
+    """ élément de la fenêtre de priorité du mode flux : le plus grand NORM_FILNAME sort en premier """
+
+    __slots__ = ('file_id',)
+
+    def __init__(self, file_id):
+        self.file_id = file_id
+
+    def __lt__(self, other):
+        return self.file_id[NORM_FILNAME] > other.file_id[NORM_FILNAME]
+
+
+class ScanBatch(list):
+    """ lot de fichiers à traiter par ordre NORM_FILNAME décroissant
+        en mode sélection le lot ne contient que les meilleurs candidats, more() donne les suivants """
+
+    def __init__(self, files=(), scanner=None):
+        super().__init__(files)
+        self.scanner = scanner
+
+    def more(self):
+        if self.scanner is None or not self.scanner.truncated:
+            return ScanBatch()
+        return self.scanner.next_selection()
 
 
 class Scanner():
 
-    
-    def __init__(self, line_filter):
+
+    def __init__(self, line_filter, stream_window=None, select_limit=None):
         
         self.files = []
-        self.audio_filter = settings.audioSignature 
+        self.stream_window = stream_window
+        self.queue = None
+        # mode sélection : tas des select_limit meilleurs candidats, ceux au-delà de select_bound sont déjà proposés
+        self.select_limit = select_limit
+        self.select_bound = None
+        self.selected_count = 0
+        self.truncated = False
+        # chemins relatifs des candidats écartés du lot : seuls leurs répertoires sont relus pour le lot suivant
+        self.leftover = set()
+        self.stopped = threading.Event()
+        self.audio_filter = settings.patterns.audio
         self.nblines_filter = 1
         self.line_filter = line_filter
         self.length = 0
@@ -506,17 +2274,138 @@ class Scanner():
         
     def __enter__(self):
 
+        if self.stream_window is not None:
+            return self.stream()
+        start = time.perf_counter()
         self.readLines()
+        bot.scan_duration = time.perf_counter() - start
+        if self.select_limit is not None:
+            bot.scan_count = self.selected_count
+            return self.selection()
+        bot.scan_count = len(self.files)
         if self.files:
             self.files.sort(key = lambda x : x[NORM_FILNAME], reverse=True)
-            return self.files
-        return []
+        return ScanBatch(self.files)
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
         # no need to treat this abnormal end so far
         pass
 
 
+    def add_file(self, file_id):
+        """ retient un fichier sélectionné, ou le transmet au traitement en mode flux """
+        if self.queue is None:
+            if self.select_limit is None:
+                self.files.append(file_id)
+            else:
+                self.select(file_id)
+            return
+        while True:
+            if self.stopped.is_set():
+                raise BTScanStopped()
+            try:
+                self.queue.put(file_id, timeout=0.5)
+                bot.scan_count += 1
+                return
+            except Full:
+                continue
+
+    def select(self, file_id):
+        """ ne garde que les select_limit plus récents (NORM_FILNAME, RELPATH) : tas dont la racine est le moins récent """
+        key = (file_id[NORM_FILNAME], file_id[RELPATH])
+        if self.select_bound is not None and key >= self.select_bound:
+            return
+        self.selected_count += 1
+        entry = (key, self.selected_count, file_id)
+        if len(self.files) < self.select_limit:
+            heapq.heappush(self.files, entry)
+        else:
+            self.truncated = True
+            if key > self.files[0][0]:
+                file_id = heapq.heapreplace(self.files, entry)[2]
+            self.leftover.add(file_id[RELPATH])
+
+    def selection(self):
+        entries = sorted(self.files, reverse=True)
+        self.files = []
+        if entries:
+            self.select_bound = entries[-1][0]
+        return ScanBatch((entry[2] for entry in entries), self)
+
+    def next_selection(self):
+        """ nouvelle analyse limitée aux fichiers moins récents que le dernier lot, avec un lot deux fois plus grand """
+        self.select_limit *= 2
+        self.truncated = False
+        bot.info()
+        bot.info(f'Limite de changements non atteinte : recherche des {self.select_limit} fichiers suivants')
+        start = time.perf_counter()
+        self.rescan()
+        bot.scan_duration += time.perf_counter() - start
+        return self.selection()
+
+    def rescan(self):
+        self.leftover = set()
+        self.readLines()
+
+    def stream(self):
+        """ mode flux : l'analyse se poursuit dans un thread pendant que les fichiers déjà trouvés sont traités
+            la file bornée limite l'avance de l'analyse, une fenêtre de stream_window fichiers
+            permet de traiter en premier les plus récents (ordre NORM_FILNAME décroissant) parmi ceux déjà trouvés """
+        self.queue = Queue(maxsize=STREAM_QUEUE_SIZE)
+        failure = []
+        producer = threading.Thread(target=self.produce, args=(failure,), name='scan', daemon=True)
+        producer.start()
+        window = []
+        try:
+            while True:
+                file_id = self.queue.get()
+                if file_id is STREAM_END:
+                    break
+                if not self.stream_window:
+                    yield file_id
+                    continue
+                heapq.heappush(window, NewestFirst(file_id))
+                if len(window) > self.stream_window:
+                    yield heapq.heappop(window).file_id
+            while window:
+                yield heapq.heappop(window).file_id
+            if failure:
+                raise failure[0]
+        finally:
+            # fin anticipée du traitement (limite de changements) : l'analyse est arrêtée
+            self.stopped.set()
+            unconsumed = [entry.file_id for entry in window]
+            while producer.is_alive():
+                try:
+                    file_id = self.queue.get(timeout=0.1)
+                except Empty:
+                    continue
+                if file_id is not STREAM_END:
+                    unconsumed.append(file_id)
+            producer.join()
+            self.stopped_at(unconsumed)
+
+    def stopped_at(self, file_ids):
+        """ fichiers trouvés par l'analyse mais jamais transmis au traitement à l'arrêt du mode flux """
+        pass
+
+    def produce(self, failure):
+        start = time.perf_counter()
+        try:
+            self.readLines()
+        except BTScanStopped:
+            pass
+        except Exception as e:
+            failure.append(e)
+        finally:
+            bot.scan_duration = time.perf_counter() - start
+            while not self.stopped.is_set():
+                try:
+                    self.queue.put(STREAM_END, timeout=0.5)
+                    break
+                except Full:
+                    continue
+
     def check_artist(self, artist) -> dict:
         """ verfie si le nom d'artiste/alias normalisé est bien présente dans la base ()"""
         norm_name = normalize_name(artist)
@@ -526,15 +2415,15 @@ class Scanner():
             artist = params[0]
             process_cp = params[1]
             raw_artiste = norm_name
-            return {ARTIST : artist ,'processCP' : process_cp , 'rawartist' : raw_artiste}
+            return {ARTIST : artist ,'processCP' : process_cp , 'rawartist' : raw_artiste, CP_SLOTS : params[2]}
         else:
             return {}
         
      
     def match_audio(self, relpath, filename):
         """ vérife que le nom du fichier audio est correct et vérifie son nom d'artiste/émission"""
-        finder = re.compile(self.audio_filter, re.I)
-        match = finder.findall(filename)
+        with bot.metrics.stage(STAGE_FILENAME_MATCH):
+            match = self.audio_filter.findall(filename)
         info = {}
         if match:
             res = match[0]
@@ -544,7 +2433,8 @@ class Scanner():
                     key = READ_FILENAME_KEYS[i]
                     info[key] = res[i]
                 
-                artist_info = self.check_artist(info[ARTIST])
+                with bot.metrics.stage(STAGE_ARTIST_LOOKUP):
+                    artist_info = self.check_artist(info[ARTIST])
                 if artist_info:
                     normfilename = re.sub(info[ARTIST], artist_info['rawartist'], filename.lower())
                     # normfilename permet de trier les fichiers par ordre chrono-inverse
@@ -557,10 +2447,10 @@ class Scanner():
                 else:
                     bot.warning(f'{relpath}{filename} : Artiste {info[ARTIST]} non présent dans la liste des émissions')
             else:
-                bot.verbose(f'{relpath}{filename} : Format de nom de fichier insuffisante ou extension invalide, analyse impossible')
+                bot.verbose('%s%s : Format de nom de fichier insuffisante ou extension invalide, analyse impossible', relpath, filename)
 
         else:
-            bot.verbose(f'{relpath}{filename} : Format de nom de fichier incorrect, analyse impossible')
+            bot.verbose('%s%s : Format de nom de fichier incorrect, analyse impossible', relpath, filename)
         return False
 
     
@@ -581,19 +2471,19 @@ class Scanner():
         """ récupère les fichiers devant être traité dans un fichier log """
         try:
             line = format_to_unixpath(line)
-            bot.verbose("Ligne analysée :" + line)
+            bot.verbose("Ligne analysée :%s", line)
             if self.current_line == 0 :
                 for found_row in self.line_filter:
-                    match = re.search(found_row[0], line, re.I)
+                    match = found_row[0].search(line)
                     if match:
                         self.nblines_filter = len(found_row) 
                         self.found_row = found_row
                         break # on sort
             else:
-                match = re.search(self.found_row[self.current_line], line, re.IGNORECASE)
+                match = self.found_row[self.current_line].search(line)
             if self.current_line == self.nblines_filter - 1:
                 if match:    
-                    bot.verbose('Correspondance : ' +match.group(1) )
+                    bot.verbose('Correspondance : %s', match.group(1))
                     self.nblines_filter = 1
                     self.current_line = 0
                     return self.extract_file_id(match.group(2))
@@ -605,11 +2495,20 @@ class Scanner():
             else:
                 # d'autre lignes sont a vérifier
                 self.current_line += 1
-                bot.verbose('Correspondance : ' +match.group(1) + ' --->> Ligne suivante')
+                bot.verbose('Correspondance : %s --->> Ligne suivante', match.group(1))
         except ValueError:
             bot.warning("La ligne n'a pas pu être correctement analysée, abandon")
             return None
 
+    def extract_action_file_id(self, filepath, moved_from=None):
+        """ récupère les infos du fichier d'une action, avec son chemin d'origine si il a été déplacé """
+        file_id = self.extract_file_id(filepath)
+        if file_id and moved_from:
+            relpath, filename = split_filepath(moved_from)
+            if relpath is not None:
+                file_id[MOVED_FROM] = relpath + filename
+        return file_id
+
     def hasnot_excludedfilepath(self, relpath, filename):
         filepath = relpath + filename
         for i in settings.excludedPaths:
@@ -625,13 +2524,55 @@ class FileScan(Scanner):
 
     """
 
-    def __init__(self, full_pathname):
+    def __init__(self, full_pathname, cursor=None):
         self.fullPathName = full_pathname
-        super().__init__(settings.syncActionLine)
-    
+        self.cursor = cursor
+        super().__init__(settings.patterns.action_lines)
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        # les logs ne sont marqués lus que si tous leurs fichiers ont été traités sans erreur
+        if self.cursor is None or exc_type is not None or settings.noAction or bot.limit_reached():
+            return
+        if bot.budget is not None and (bot.budget.exhausted or bot.budget.deferred):
+            bot.info("Temps alloué écoulé : les logs seront relus au prochain traitement")
+            return
+        if bot.fail_count:
+            bot.info(f"{bot.fail_count} fichier(s) en erreur : les logs seront relus au prochain traitement")
+            return
+        self.cursor.save()
+
     def readLines(self):
         
         bot.info(STARS)
+        if self.cursor is not None:
+            result = self.readPending()
+        else:
+            result = self.readLog()
+        self.coalesce()
+        return result
+
+    def coalesce(self):
+        """ fusionne les événements successifs d'un même fichier (création, mise à jour, déplacement)
+            en un seul traitement sur son chemin final """
+        events = {}
+        merged = 0
+        for file_id in self.files:
+            key = file_id[RELPATH] + file_id[FILENAME]
+            source = file_id.pop(MOVED_FROM, None)
+            if source is not None and source != key and source in events:
+                # le fichier a été déplacé : les événements sur son ancien chemin sont repris par le nouveau
+                del events[source]
+                merged += 1
+            if key in events:
+                del events[key]
+                merged += 1
+            events[key] = file_id
+        self.files = list(events.values())
+        if merged:
+            bot.info(f"{merged} événement(s) fusionné(s) : {len(self.files)} fichier(s) distinct(s) à traiter")
+
+    def readLog(self):
+        """ lit un log de synchronisation en entier """
         bot.info(f"Fichier log sync séléctionné : {self.fullPathName}")
         bot.info(f'Exclusion des fichiers/dossiers contenant : {" / ".join(settings.excludedPaths)}')
         bot.info()
@@ -641,14 +2582,102 @@ class FileScan(Scanner):
         else:
             try:
                 with open(self.fullPathName,'r',-1,"utf-8") as source:
-                    for line in source:
-                        file_id = self.get_file_id(line)
-                        if file_id:    
-                            self.files.append(file_id)
+                    self.scan_text(source.read())
                     return True
             except OSError as e:
                 bot.error(f"Problème fatal durant la lecture du fichier {self.fullPathName}\nDétail : {e}" )
 
+    def readPending(self):
+        """ lit la partie non lue de chaque log de synchronisation du répertoire """
+        self.cursor.load()
+        pending = self.cursor.pending(self.fullPathName, settings.syncSignature)
+        bot.info(f"Répertoire des logs sync : {self.fullPathName}, {len(pending)} log(s) à lire")
+        bot.info(f'Exclusion des fichiers/dossiers contenant : {" / ".join(settings.excludedPaths)}')
+        bot.info()
+        for filename, offset in pending:
+            full_pathname = self.fullPathName + filename
+            try:
+                with open(full_pathname, 'rb') as source:
+                    source.seek(offset)
+                    data = source.read()
+            except OSError as e:
+                bot.error(f"Problème durant la lecture du fichier {full_pathname}\nDétail : {e}" )
+                continue
+            bot.detail(f"Lecture de {filename} à partir de l'octet {offset}")
+            # seules les lignes complètes sont lues, la fin d'un log en cours d'écriture sera lue au prochain passage
+            data = data[:data.rfind(b'\n') + 1]
+            text = data.decode('utf-8', errors='replace').replace('\r\n', '\n')
+            incomplete = self.scan_text(text)
+            if incomplete is None:
+                offset += len(data)
+            else:
+                # une action sur plusieurs lignes incomplète est relue en entier la prochaine fois
+                offset += self.line_offset(data, text.count('\n', 0, incomplete))
+            self.cursor.advance(filename, offset)
+        return True
+
+    @staticmethod
+    def line_offset(data, line):
+        """ position en octets du début de la ligne line dans data
+            le décodage peut changer la longueur du texte (octets invalides, fins de ligne) mais pas le nombre de lignes """
+        position = 0
+        for _ in range(line):
+            position = data.index(b'\n', position) + 1
+        return position
+
+    def scan_text(self, text):
+        """ recherche en une seule passe les lignes d'en-tête de toutes les actions,
+            seules les lignes suivant un en-tête d'action sur plusieurs lignes sont ensuite analysées
+
+        Returns:
+            int: position du début d'une action sur plusieurs lignes incomplète en fin de texte, None sinon
+        """
+        text = text.replace('\\', '/')
+        resume = 0
+        for hit in settings.patterns.action_heads.finditer(text):
+            if hit.start() < resume:
+                # ligne déjà lue comme suite d'une action
+                continue
+            start = text.rfind('\n', 0, hit.start()) + 1
+            line, resume = self.next_line(text, start)
+            # la première action de la liste correspondant à la ligne est retenue, comme ligne par ligne
+            for row in self.line_filter:
+                match = row[0].search(line)
+                if match:
+                    break
+            else:
+                continue
+            bot.verbose("Ligne analysée :%s", line)
+            moved_from = None
+            for i in range(1, len(row)):
+                if resume >= len(text):
+                    return start
+                line, resume = self.next_line(text, resume)
+                match = row[i].search(line)
+                if not match:
+                    break
+                if i < len(row) - 1:
+                    # chemin d'origine d'un déplacement sur plusieurs lignes
+                    quoted = QUOTED_PATH.search(line)
+                    if quoted:
+                        moved_from = quoted.group(1)
+            if match:
+                bot.verbose('Correspondance : %s', match.group(1))
+                file_id = self.extract_action_file_id(match.group(2), moved_from)
+                if file_id:
+                    self.add_file(file_id)
+            else:
+                bot.verbose("Pas de correspondance")
+        return None
+
+    @staticmethod
+    def next_line(text, start):
+        """ retourne la ligne commençant à start et la position de la ligne suivante """
+        end = text.find('\n', start)
+        if end < 0:
+            end = len(text)
+        return text[start:end].rstrip('\r'), end + 1
+
 
 class DirScan(Scanner):
     
@@ -657,9 +2686,16 @@ class DirScan(Scanner):
 
     """
     
-    def __init__(self):
-        super().__init__([['(^)(.*)']])
+    def __init__(self, stream_window=None, select_limit=None):
+        super().__init__([[ANY_LINE]], stream_window, select_limit)
         self.directoryName = settings.root[LOCAL]
+        self.listed_dirs = {}
+        # répertoires dont tous les fichiers ont été parcourus, les seuls pouvant être mémorisés
+        self.traversed = set()
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if exc_type is None and settings.scanPruneDirs and bot.index is not None:
+            self.save_dirs()
 
     def readLines(self):
         bot.info(STARS)
@@ -669,11 +2705,139 @@ class DirScan(Scanner):
         bot.info(f'Exclusion de ceux contenant : {" / ".join(settings.excludedPaths)}')
         bot.info()
 
-        for (root, dir, files) in os.walk(self.directoryName, topdown=True):
-            for line in files:
-                file = self.get_file_id(root+'/' +line)
-                if file:    
-                    self.files.append(file)
+        unchanged = 0
+        if settings.scanPruneDirs:
+            walker = self.walk_pruned(self.directoryName)
+        else:
+            walker = os.walk(self.directoryName, topdown=True)
+        for (root, dir, files) in bot.metrics.iterate(walker, STAGE_WALK):
+            # mode flux arrêté : le répertoire suivant n'est pas commencé
+            if self.stopped.is_set():
+                raise BTScanStopped()
+            selected, skipped = self.read_files(root, files)
+            unchanged += skipped
+            if root in self.listed_dirs:
+                self.listed_dirs[root][4] = selected
+            # un arrêt du mode flux au milieu des fichiers (BTScanStopped) laisse le répertoire non parcouru
+            self.traversed.add(root)
+        if bot.index is not None:
+            bot.info(f'{unchanged} fichier(s) inchangé(s) depuis leur dernière vérification ignoré(s)')
+
+    def read_files(self, root, files):
+        """ retient les fichiers audio d'un répertoire, retourne les nombres de fichiers sélectionnés et inchangés """
+        selected = 0
+        unchanged = 0
+        for line in files:
+            if bot.index is not None and self.is_indexed(root+'/' +line):
+                unchanged += 1
+                continue
+            file = self.get_file_id(root+'/' +line)
+            if file:    
+                self.add_file(file)
+                selected += 1
+        return selected, unchanged
+
+    def rescan(self):
+        """ mode sélection : seuls les répertoires contenant des candidats non retenus dans les lots précédents sont relus,
+            l'arborescence n'est pas parcourue à nouveau """
+        relpaths, self.leftover = self.leftover, set()
+        for relpath in sorted(relpaths):
+            directory = settings.root[LOCAL] + relpath
+            try:
+                with os.scandir(directory) as entries:
+                    files = [entry.name for entry in entries if not entry.is_dir()]
+            except OSError as e:
+                bot.warning(f'Lecture impossible du répertoire {directory}\nDétail : {e}')
+                continue
+            self.read_files(directory.rstrip('/'), files)
+
+    def stopped_at(self, file_ids):
+        """ les répertoires des fichiers non transmis au traitement ne sont pas entièrement parcourus """
+        # chemins comparés avec un seul '/' final : la racine se termine déjà par '/', pas ses sous-répertoires
+        stop_dirs = {(settings.root[LOCAL] + file_id[RELPATH]).rstrip('/') + '/' for file_id in file_ids}
+        if stop_dirs:
+            self.traversed = {root for root in self.traversed if format_to_unixpath(root).rstrip('/') + '/' not in stop_dirs}
+
+    def walk_pruned(self, top):
+        """ parcours équivalent à os.walk qui ne liste pas les répertoires exclus, ni ceux inchangés
+            depuis la dernière analyse complète (même date de modification et même nombre d'entrées)"""
+        pruned = 0
+        unchanged = 0
+        if bot.index is not None:
+            bot.index.check_dirs(self.dirs_signature())
+        stack = [top]
+        while stack:
+            directory = stack.pop()
+            relpath = format_to_unixpath(directory)[len(top):]
+            if self.is_excludeddir(relpath):
+                bot.verbose('Répertoire %s exclu, non parcouru', relpath)
+                pruned += 1
+                continue
+            try:
+                mtime = os.stat(directory).st_mtime_ns
+            except OSError as e:
+                bot.warning(f'Répertoire {directory} inaccessible\nDétail : {e}')
+                continue
+            files, subdirs = [], []
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_dir():
+                            subdirs.append(entry.name)
+                        else:
+                            files.append(entry.name)
+            except OSError as e:
+                bot.warning(f'Lecture impossible du répertoire {directory}\nDétail : {e}')
+                continue
+            stack.extend(os.path.join(directory, name) for name in reversed(subdirs))
+            known = bot.index.get_dir(relpath) if bot.index is not None else None
+            if known is not None and known[0] == mtime and known[1] == len(files) + len(subdirs):
+                # répertoire inchangé : ses fichiers ont tous été vérifiés, seuls les sous-répertoires sont à voir
+                # (la date de modification d'un partage réseau peut ne pas changer à l'ajout d'un fichier)
+                unchanged += 1
+                continue
+            # le dernier élément reçoit le nombre de fichiers sélectionnés une fois le répertoire parcouru
+            self.listed_dirs[directory] = [relpath, mtime, len(files) + len(subdirs), subdirs, None]
+            if self.has_pathfilter(relpath):
+                yield directory, subdirs, files
+        bot.info(f'{pruned} répertoire(s) exclu(s) et {unchanged} répertoire(s) inchangé(s) non parcouru(s)')
+
+    def is_excludeddir(self, relpath):
+        """ un répertoire exclu l'est pour tous les fichiers de sa sous-arborescence """
+        for i in settings.excludedPaths:
+            if i and i.lower() in relpath:
+                return True
+        return False
+
+    def has_pathfilter(self, relpath):
+        """ en mode élagage le filtre de chemin ne porte que sur le répertoire, qui est parcouru si l'un des filtres y figure """
+        if not settings.scanPathFilter:
+            return True
+        return any(i.lower() in relpath for i in settings.scanPathFilter)
+
+    @staticmethod
+    def dirs_signature():
+        """ empreinte des paramètres décidant quels fichiers d'un répertoire sont à vérifier """
+        params = [sorted(bot.RBProgs.items()), settings.audioSignature, sorted(settings.excludedPaths)]
+        return hashlib.sha1(json.dumps(params, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def save_dirs(self):
+        """ mémorise les répertoires entièrement parcourus dont tous les fichiers sont vérifiés,
+            uniquement après une analyse complète """
+        if any(settings.scanPathFilter) or any(settings.scanAudioFilter):
+            return
+        for directory, (relpath, mtime, entries, subdirs, selected) in self.listed_dirs.items():
+            if directory not in self.traversed or selected is None:
+                continue
+            files_relpath = format_to_unixpath(directory)[len(settings.root[LOCAL]):].strip('/')
+            if bot.index.is_verified(files_relpath + '/' if files_relpath else '', selected):
+                bot.index.set_dir(relpath, mtime, entries, subdirs)
+
+    def is_indexed(self, filepath):
+        """ vérifie si le fichier est déjà vérifié et inchangé d'après l'index """
+        filepath = format_to_unixpath(filepath)
+        relpath, filename = split_filepath(filepath)
+        return relpath is not None and bot.index.is_unchanged(relpath, filename, filepath)
         
     def hasnot_excludedfilepath(self, relpath, filename):
         if not super().hasnot_excludedfilepath(relpath, filename):
@@ -682,13 +2846,13 @@ class DirScan(Scanner):
         
         for i in settings.scanPathFilter:
             if i.lower() not in filepath:
-                bot.verbose(f'Répertoire {filepath} non retenu, ne contient pas {" ou ". join(settings.scanPathFilter)}')
+                bot.verbose(lambda: f'Répertoire {filepath} non retenu, ne contient pas {" ou ". join(settings.scanPathFilter)}')
                 return False
             else:
                 break
         for i in settings.scanAudioFilter:
             if i.lower() not in filename:
-                bot.verbose(f'{filename} non retenu, ne contient pas {" ou ". join(settings.scanAudioFilter)}')
+                bot.verbose(lambda: f'{filename} non retenu, ne contient pas {" ou ". join(settings.scanAudioFilter)}')
                 return False
             else:
                 break
@@ -709,37 +2873,44 @@ class AudioFile:
             RBFileNotFound: _description_
         """
 
-        self.models ={SOURCE : None, CURRENT : None, PREVIOUS : None}
+        self.models ={SOURCE : None}
         self.has_changed = False
+        self.cp_state = None
         
         self.filename = file_id[FILENAME]
         self.relative_path = file_id[RELPATH]
+        self.file_id = file_id
+        self.artist = file_id[ARTIST]
         self.process_cp = file_id['processCP']
+        self.cp_models = [slot_model(rank) for rank in range(file_id.get(CP_SLOTS, DEFAULT_CP_SLOTS))] if self.process_cp else []
+        self.cp_batch = file_id.get(CP_BATCH)
+        self.journal_pos = file_id.get(JOURNAL_POS)
+        self.journal_steps = 0
         tags = {}
         for key in READ_FILENAME_KEYS:
             tags[key] = file_id[key] 
         
         self.load_models_sets(calc_tags=tags)
-        self.load_modelstags()
+        # les fichiers current/previous ne sont lus qu'au besoin, lors de leur rotation
+        self.load_modeltags()
         for root in settings.root:
             path = self.get_full_filepath(root=root)
-            if (root != DISTANT or settings.makeDistCopy) and not os.path.exists(path):
+            if (root != DISTANT or settings.makeDistCopy) and not bot.dircache.exists(path):
                 raise BTFileNotFound(path)
 
     def load_modelstags(self, root=LOCAL):
-        for model in PHY_MODELS : # 
-            if self.process_cp or model == SOURCE:
-                self.load_modeltags(model, root)
+        for model in [SOURCE] + self.cp_models :
+            self.load_modeltags(model, root)
 
     def load_modeltags(self, model=SOURCE, root=LOCAL):
-        full_pathname = self.get_full_filepath(model, root, calc=True)
-        if os.path.exists(full_pathname):
+        # le fichier source est lu sous son nom réel, qui peut différer du nom calculé (alias)
+        full_pathname = self.get_full_filepath(model, root, calc=model != SOURCE)
+        if bot.dircache.exists(full_pathname):
             self.models[model].loadSet(full_pathname)
             
     def load_models_sets(self, root=LOCAL, calc_tags=None):
-        for model in PHY_MODELS : # 
-            if self.process_cp or model == SOURCE:
-                self.models[model] = self.load_model_sets(model, root, calc_tags)
+        for model in [SOURCE] + self.cp_models :
+            self.models[model] = self.load_model_sets(model, root, calc_tags)
             
     def load_model_sets(self, model, root=LOCAL, calc_tags = None):
         return TagsModel(model, root, calc_tags)
@@ -755,7 +2926,7 @@ class AudioFile:
         if model == SOURCE and not calc:
             return  self.filename
         else:
-           return   '.' .join(["#".join(self.get_tag(field, model, calc=True) for field in CALC_FILENAME[model] \
+           return   '.' .join(["#".join(self.get_tag(field, model, calc=True) for field in CALC_FILENAME[base_model(model)] \
                         if self.get_tag(field, model, calc=True) ) , self.get_tag(EXT, SOURCE, calc=True)])
     
     def get_rootdir(self, root=LOCAL):
@@ -805,10 +2976,11 @@ class AudioFile:
                 self.has_changed = True
                 if settings.makeDistCopy:
                     root = DISTANT
-                    self.models[model].loadSet(self.get_full_filepath(model, root))
-                    self.models[model].save()
-                    bot.info("OK distant : " + message)
-            except MutagenError :
+                    local_file, dist_file = self.get_full_filepath(model), self.get_full_filepath(model, root)
+                    tags = self.models[model].detached() if settings.distPropagation == PROPAGATE_RETAG else None
+                    bot.distant_op(self.file_id, f"Modification des tags de {dist_file}", bot.dircache.getsize(local_file),
+                                   self.retag_dist, model, tags, local_file, dist_file)
+            except (MutagenError, OSError) :
                 raise BTTagError(model, root)
             else :
                 return True                
@@ -822,22 +2994,25 @@ class AudioFile:
         dist_file = self.get_full_filepath(model_destination)
         if not settings.noAction:
             try:
-                cmd = 'copy /Y "' + format_to_unixpath(source_file, reverse=True) + '" "' + \
-                    format_to_unixpath(dist_file, reverse = True)+ '" 2>&1'
-                bot.verbose(f"Commande : {cmd}")
-                result = subprocess.call(cmd, shell=True)
-                if result == 0:
-                    bot.detail("Copie effectuée")
+                step = self.journal_step(JOURNAL_COPY, source_file, dist_file)
+                with bot.metrics.stage(STAGE_LOCAL_COPY):
+                    size, lasting = copy_file(source_file, dist_file)
+                bot.dircache.written(dist_file)
+                step.state(STEP_COPIED)
+                bot.detail("Copie effectuée : %d octets en %.3f s", size, lasting)
                 self.models[model_destination].loadSet(dist_file)
                 self.models[model_destination].save(model_destination)
+                step.state(STEP_LOCAL)
                 self.has_changed = True
                 bot.info( f"OK : Copie du fichier {source_file}  vers {dist_file}")
                 
                 if settings.makeDistCopy:
                     source_file = self.get_full_filepath(model_destination)
                     dist_file = self.get_full_filepath(model_destination, DISTANT)
-                    shutil.copy2(source_file, dist_file)
-                    bot.info(f"OK : Copie du fichier {model_destination}  de local à distant")
+                    bot.distant_op(self.file_id, f"Copie de {source_file} vers {dist_file}", size,
+                                   self.copy_dist, model_destination, source_file, dist_file, step)
+                else:
+                    step.state(STEP_DONE)
             except OSError:
                 raise BTCopyError(source_file, dist_file)
 
@@ -849,49 +3024,200 @@ class AudioFile:
         audio = self.get_relative_filepath(model_source)
         message = f"Renommage du fichier {audio} de {model_source} à {model_destination}"
         if not settings.noAction:
+            if model_source == SOURCE:
+                # la correction des tags distants en attente relit peut-être le fichier local renommé
+                bot.wait_artist(self.artist)
             try:
                 source_file = self.get_full_filepath(model_source)
                 dest_file = self.get_full_filepath(model_destination, calc=True)
+                step = self.journal_step(JOURNAL_MOVE, source_file, dest_file)
                 self.models[model_source].save(model = model_destination )
-                os.replace(source_file, dest_file)
+                step.state(STEP_TAGGED)
+                bot.io.acquire()
+                with bot.metrics.stage(STAGE_RENAME):
+                    os.replace(source_file, dest_file)
+                bot.dircache.moved(source_file, dest_file)
+                step.state(STEP_LOCAL)
                 self.has_changed = True
                 bot.info( message )
                 if settings.makeDistCopy:
+                    local_file = dest_file
                     source_file = self.get_full_filepath(model_source, DISTANT)
                     dest_file = self.get_full_filepath(model_destination, DISTANT, calc=True)
-                    self.models[model_source].loadSet(source_file)
-                    self.models[model_source].save(model_destination)
-                    os.replace(source_file, dest_file)
-                    shutil.copystat(self.get_full_filepath(model_destination, LOCAL), dest_file)
+                    tags = self.models[model_source].detached() if settings.distPropagation == PROPAGATE_RETAG else None
+                    bot.distant_op(self.file_id, f"Renommage de {source_file} en {dest_file}", bot.dircache.getsize(local_file),
+                                   self.move_dist, model_destination, tags, source_file, dest_file, local_file, step)
+                else:
+                    step.state(STEP_DONE)
             except OSError as e:
                 raise BTMoveError(source_file, dest_file, e)
         else:
             bot.info("NoAction : {message}")
 
-    def manage_cp(self):
-        """ gestion des fichiers current et previous - fichiers les 2 plus récents pour chaque emission"""
-
-        if self.models[CURRENT].hasFile:
-            state = self.compare_modeltag(SOURCE, CURRENT)
-            if state == BIGGER:
-                bot.info('Fichier #current plus ancien')
-                bot.info('Fichier current remplace #previous')
-                self.move_audio(CURRENT, PREVIOUS)
-                bot.info('Fichier traité remplace #current')
-                self.copy_audio(SOURCE, CURRENT)
-            elif state == SMALLER:
-                bot.info('Fichier #current plus récent')
-                if not self.models[PREVIOUS].hasFile or self.compare_modeltag(SOURCE, PREVIOUS) == BIGGER:
-                        bot.info('Fichier #previous plus ancien ou inexistant')
-                        bot.info('Fichier traité se duplique en #previous')
-                        self.copy_audio(SOURCE, PREVIOUS)
-                else:
-                    bot.info('Fichier #previous plus ou aussi récent')
+    def copy_dist(self, model, local_file, dist_file, step):
+        """ copie vers la racine distante du fichier local déjà tagué """
+        with bot.metrics.stage(STAGE_DISTANT_COPY):
+            size, lasting = copy_file(local_file, dist_file)
+        bot.dircache.written(dist_file)
+        bot.count_distant_bytes(size)
+        bot.info(f"OK : Copie du fichier {model}  de local à distant")
+        bot.detail("Copie effectuée : %d octets en %.3f s", size, lasting)
+        step.state(STEP_DONE)
+
+    def move_dist(self, model_destination, tags, source_file, dest_file, local_file, step):
+        """ report sur la racine distante d'un renommage local, tags réécrits (tags) ou recopiés depuis local_file """
+        try:
+            if tags is not None:
+                tags.loadSet(source_file)
+                tags.save(model_destination)
+                bot.io.acquire()
+                with bot.metrics.stage(STAGE_RENAME):
+                    os.replace(source_file, dest_file)
+                bot.dircache.moved(source_file, dest_file)
+                shutil.copystat(local_file, dest_file)
             else:
-                bot.info('Fichier traité identique au #current')   
-        else:
-            bot.info('Fichier traité se duplique en #current (inexistant)')
-            self.copy_audio(SOURCE, CURRENT)
+                bot.io.acquire()
+                with bot.metrics.stage(STAGE_RENAME):
+                    os.replace(source_file, dest_file)
+                bot.dircache.moved(source_file, dest_file)
+                self.propagate_dist(local_file, dest_file)
+        except OSError as e:
+            raise BTMoveError(source_file, dest_file, e)
+        step.state(STEP_DONE)
+
+    def retag_dist(self, model, tags, local_file, dist_file):
+        """ report sur la racine distante d'une correction des tags locaux """
+        try:
+            if tags is not None:
+                tags.loadSet(dist_file)
+                tags.save()
+            else:
+                self.propagate_dist(local_file, dist_file)
+        except (MutagenError, OSError) :
+            raise BTTagError(model, DISTANT, dist_file)
+        bot.info("OK distant : Modification des tags ID3")
+
+    def journal_step(self, op, source_file, dest_file):
+        if bot.journal is None or self.journal_pos is None:
+            return JournalStep()
+        return bot.journal.step(self, op, source_file, dest_file)
+
+    def propagate_dist(self, local_file, dist_file):
+        """ aligne le fichier distant sur le fichier local déjà tagué, sans nouvelle analyse par mutagen
+            en mode patch seul le bloc des tags est réécrit, le fichier est recopié si les tailles diffèrent """
+        if settings.distPropagation == PROPAGATE_PATCH:
+            with bot.metrics.stage(STAGE_DISTANT_COPY):
+                size = patch_tags(local_file, dist_file)
+            if size is not None:
+                bot.dircache.written(dist_file)
+                bot.count_distant_bytes(size)
+                bot.detail("Tags distants remplacés : %d octets", size)
+                return
+            bot.verbose("Tailles des tags différentes, copie complète vers %s", dist_file)
+        with bot.metrics.stage(STAGE_DISTANT_COPY):
+            size, lasting = copy_file(local_file, dist_file)
+        bot.dircache.written(dist_file)
+        bot.count_distant_bytes(size)
+        bot.detail("Copie effectuée : %d octets en %.3f s", size, lasting)
+
+    def manage_cp(self):
+        """ gestion des fichiers current, previous et previousN - les N fichiers les plus récents de chaque émission
+            l'index ordonné des emplacements de l'artiste donne la position du fichier traité :
+            seuls les emplacements plus anciens que cette position sont décalés
+            retourne la décision prise (modèle remplacé par le fichier traité ou None)"""
+
+        keys, reserved, holes = self.cp_slots()
+        source_id = self.models[SOURCE].getCalcID()
+        position = len(keys) - bisect_right(keys, source_id)
+        if source_id in reserved:
+            # emplacement préparé lors du traitement du fichier le plus récent du lot
+            model = self.cp_models[position]
+            bot.info(f'Fichier traité se duplique en #{model} (emplacement réservé)')
+            self.copy_slot(model, source_id, holes)
+            reserved.discard(source_id)
+            return model
+        for slot in (position - 1, position):
+            if 0 <= slot < len(keys) and str_compare(source_id, keys[-1 - slot]) in [EQUAL, SIMILAR]:
+                bot.info(f'Fichier traité identique au #{self.cp_models[slot]}')
+                return CURRENT if slot == 0 else None
+        if position >= len(self.cp_models):
+            bot.info(f'Fichiers #{self.cp_models[-1]} et précédents plus récents')
+            return None
+
+        incoming = [source_id]
+        if self.cp_batch and settings.changeLimit <= 0 and bot.budget is None:
+            # fichiers plus anciens du lot encore à traiter : leur place est réservée dès maintenant
+            # seulement si tout le lot sera traité, une limite de changements ou le temps alloué peut être atteint avant eux
+            # (en parallèle, par les fichiers des autres artistes)
+            incoming += [key for key in self.cp_batch if key not in keys]
+        layout = sorted(set(keys + incoming))[-len(self.cp_models):]
+        for index in range(len(keys)):
+            # du plus ancien au plus récent : la destination est libre ou déjà déplacée
+            key = keys[index]
+            slot = len(keys) - 1 - index
+            if key in layout and len(layout) - 1 - layout.index(key) != slot:
+                model, new_model = self.cp_models[slot], self.cp_models[len(layout) - 1 - layout.index(key)]
+                bot.info(f'Fichier {model} remplace #{new_model}')
+                self.load_modeltags(model)
+                self.move_audio(model, new_model)
+        model = self.cp_models[len(layout) - 1 - layout.index(source_id)]
+        bot.info(f'Fichier traité remplace #{model}')
+        if not settings.noAction:
+            keys[:] = layout
+            reserved.update(key for key in incoming[1:] if key in layout)
+        self.copy_slot(model, source_id, holes)
+        return model
+
+    def copy_slot(self, model, source_id, holes):
+        """ copie le fichier traité dans son emplacement, l'emplacement est marqué vide si la copie échoue """
+        try:
+            self.copy_audio(SOURCE, model)
+        except Exception:
+            holes.add(source_id)
+            raise
+
+    def cp_slots(self):
+        """ retourne l'index ordonné (du plus ancien au plus récent) des identifiants des fichiers current/previous
+            de l'artiste, les identifiants réservés aux fichiers du lot restant à traiter et ceux des emplacements vides
+            l'index est construit à la première rencontre de l'artiste puis tenu à jour à chaque rotation,
+            les emplacements vides (copie en échec, rotation interrompue) sont comblés par les fichiers plus anciens """
+        artist = self.get_tag(ARTIST, calc=True)
+        if artist not in bot.cp_index:
+            keys, models = [], []
+            for model in self.cp_models:
+                self.load_modeltags(model)
+                if not self.models[model].hasFile:
+                    continue
+                key = self.models[model].getCalcID()
+                if keys and key >= keys[-1]:
+                    bot.warning(f'Fichier #{model} de {artist} plus récent que le précédent : emplacements suivants ignorés')
+                    break
+                keys.append(key)
+                models.append(model)
+            for slot, model in enumerate(models):
+                if model != self.cp_models[slot]:
+                    bot.info(f'Emplacement #{self.cp_models[slot]} de {artist} vide : #{model} y est déplacé')
+                    self.move_audio(model, self.cp_models[slot])
+            bot.cp_index[artist] = (keys[::-1], set(), set())
+        keys, reserved, holes = bot.cp_index[artist]
+        if holes:
+            self.compact_slots(keys, reserved, holes)
+        return keys, reserved, holes
+
+    def compact_slots(self, keys, reserved, holes):
+        """ retire de l'index les emplacements vides, les fichiers plus anciens sont remontés d'autant de rangs """
+        slots = {key : len(keys) - 1 - index for index, key in enumerate(keys)}
+        keys[:] = [key for key in keys if key not in holes]
+        holes.clear()
+        # du plus récent au plus ancien : la destination est vide ou déjà déplacée
+        for index in range(len(keys) - 1, -1, -1):
+            key = keys[index]
+            slot, new_slot = slots[key], len(keys) - 1 - index
+            if slot != new_slot and key not in reserved:
+                model, new_model = self.cp_models[slot], self.cp_models[new_slot]
+                bot.info(f'Fichier {model} remplace #{new_model} (emplacement vide)')
+                self.load_modeltags(model)
+                self.move_audio(model, new_model)
 
     def save_correct_filename(self):
         """ renomme le fchier audio lorsque son nom est incorrect"""
@@ -0,0 +1,105 @@
+""" Environnement commun des tests : archive synthétique du banc d'essai et moteurs botag démarrés sur celle-ci """
+import os
+import sys
+import random
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+import botools
+import bench_suite
+from botools import Engine
+
+
+@pytest.fixture
+def engine():
+    """ moteur non démarré : entrées/sorties sans limite, pas d'index ni de journal """
+    bot = Engine(-1, 0)
+    yield bot
+    bot.close()
+
+
+@pytest.fixture
+def workspace(tmp_path):
+    """ archive de 40 fichiers (racines locale et distante, log de synchronisation) : paramètres, émissions et log """
+    settings, programmes, sync_log = bench_suite.make_archive(str(tmp_path), 40, 0.3, 0.0, random.Random(5))
+    botools.settings = settings
+    return settings, programmes, sync_log
+
+
+@pytest.fixture
+def start(workspace):
+    """ démarre un moteur sur l'archive avec les paramètres en cours, éventuellement une autre liste d'émissions """
+    engines = []
+
+    def start_engine(programmes=None):
+        settings, archive_programmes, sync_log = workspace
+        botools.settings = settings
+        bot = Engine(-1, 0)
+        bot.start(settings)
+        bot.RBProgs = bench_suite.load_programmes(archive_programmes if programmes is None else programmes)
+        engines.append(bot)
+        return bot
+
+    yield start_engine
+    for bot in engines:
+        bot.close()
+
+
+@pytest.fixture
+def reference(tmp_path, workspace):
+    """ traitement séquentiel d'une archive identique : titres de tous les fichiers locaux et distants, nombre de changements
+        à demander avant le moteur testé, le dernier moteur créé devient le moteur du module """
+    settings, programmes, sync_log = bench_suite.make_archive(str(tmp_path / 'reference'), 40, 0.3, 0.0, random.Random(5))
+    botools.settings = settings
+    bot = Engine(-1, 0)
+    bot.start(settings)
+    bot.RBProgs = bench_suite.load_programmes(programmes)
+    process(bot)
+    result = (titles(settings), titles(settings, 'distant'), bot.change_count)
+    botools.settings = workspace[0]
+    return result
+
+
+@pytest.fixture
+def archive(workspace, start):
+    """ moteur démarré sur l'archive : moteur, paramètres, émissions et log """
+    return (start(),) + workspace
+
+
+def process(bot):
+    """ boucle principale de botag.py en mode séquentiel jusqu'à la fermeture du moteur, retourne les fichiers traités """
+    processed = []
+    with bot.scan() as files:
+        while files:
+            for file_id in bot.plan_cp(files):
+                bot.manageAudioSet(file_id)
+                processed.append(file_id)
+            files = files.more()
+    bot.close()
+    return processed
+
+
+def slots(settings, root='local'):
+    """ fichiers current/previous présents : nom de fichier -> titre """
+    from mutagen.easyid3 import EasyID3
+    directory = settings.root[root] + settings.currentPath
+    if not os.path.isdir(directory):
+        return {}
+    return {name : EasyID3(directory + name)['title'][0] for name in sorted(os.listdir(directory))}
+
+
+def titles(settings, root='local'):
+    """ tous les fichiers mp3 de la racine : chemin relatif -> titre """
+    from mutagen.easyid3 import EasyID3
+    directory = settings.root[root]
+    result = {}
+    for path, dirs, files in os.walk(directory):
+        for name in files:
+            if name.endswith('.mp3'):
+                relpath = os.path.relpath(os.path.join(path, name), directory).replace(os.sep, '/')
+                result[relpath] = EasyID3(os.path.join(path, name))['title'][0]
+    return result
@@ -0,0 +1,64 @@
+import errno
+import os
+
+import pytest
+
+import botools
+from botools import copy_content, copy_file
+
+DATA = bytes(range(256)) * 4096
+
+
+@pytest.fixture
+def files(tmp_path, engine):
+    source = tmp_path / 'source.mp3'
+    source.write_bytes(DATA)
+    return str(source), str(tmp_path / 'dest.mp3')
+
+
+def copy(source_file, dest_file, size=len(DATA), offset=0):
+    with open(source_file, 'rb') as source, open(dest_file, 'wb') as dest:
+        return copy_content(source, dest, size, offset)
+
+
+def test_kernel_copy(files):
+    assert copy(*files) == len(DATA)
+    assert open(files[1], 'rb').read() == DATA
+
+
+def test_unsupported_method_falls_back(files, monkeypatch):
+    def unsupported(source, dest, count, offset, dest_offset):
+        raise OSError(errno.EXDEV, 'copie noyau impossible')
+    monkeypatch.setattr(botools, 'COPY_METHODS', [unsupported])
+    assert copy(*files) == len(DATA)
+    assert open(files[1], 'rb').read() == DATA
+
+
+def test_short_kernel_copy_resumes_with_next_method(files, monkeypatch):
+    def short(source, dest, count, offset, dest_offset):
+        # copie partielle puis plus rien : la méthode suivante reprend à la position atteinte
+        if offset >= 1000:
+            return 0
+        return os.pwrite(dest, os.pread(source, min(count, 1000 - offset), offset), dest_offset)
+    monkeypatch.setattr(botools, 'COPY_METHODS', [short])
+    assert copy(*files) == len(DATA)
+    assert open(files[1], 'rb').read() == DATA
+
+
+def test_other_errors_are_raised(files, monkeypatch):
+    def failing(source, dest, count, offset, dest_offset):
+        raise OSError(errno.EIO, 'erreur disque')
+    monkeypatch.setattr(botools, 'COPY_METHODS', [failing])
+    with pytest.raises(OSError):
+        copy(*files)
+
+
+def test_copy_from_offset(files):
+    assert copy(*files, size=100, offset=10) == 100
+    assert open(files[1], 'rb').read() == DATA[10:110]
+
+
+def test_copy_file_leaves_no_partial_file(files):
+    size, _ = copy_file(*files)
+    assert size == len(DATA)
+    assert not os.path.exists(files[1] + botools.COPY_PARTIAL_EXT)
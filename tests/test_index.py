@@ -0,0 +1,57 @@
+import os
+
+from conftest import process, slots
+from botools import ARTIST
+
+
+def test_verified_files_are_skipped(workspace, start):
+    settings = workspace[0]
+    settings.scanIndex = os.path.join(settings.logPath, 'index.db')
+    assert len(process(start())) == 40
+    assert process(start()) == []
+
+
+def test_changed_file_is_verified_again(workspace, start):
+    settings = workspace[0]
+    settings.scanIndex = os.path.join(settings.logPath, 'index.db')
+    processed = process(start())
+    changed = processed[0]
+    full_pathname = settings.root['local'] + changed['relpath'] + changed['filename']
+    stat = os.stat(full_pathname)
+    os.utime(full_pathname, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert [file_id['filename'] for file_id in process(start())] == [changed['filename']]
+
+
+def test_programme_change_clears_the_index(workspace, start):
+    """ émissions passées en current/previous : leurs fichiers déjà vérifiés sont traités à nouveau """
+    settings, programmes, sync_log = workspace
+    settings.scanIndex = os.path.join(settings.logPath, 'index.db')
+    without_cp = [(name, False, count, aliases) for name, status, count, aliases in programmes]
+    process(start(without_cp))
+    assert slots(settings) == {}
+
+    processed = process(start())
+    assert len(processed) == 40
+    artists = {file_id[ARTIST] for file_id in processed if file_id['processCP']}
+    assert artists
+    assert {slot.split('#')[0] for slot in slots(settings)} == artists
+
+
+def test_setting_change_clears_the_index(workspace, start):
+    settings = workspace[0]
+    settings.scanIndex = os.path.join(settings.logPath, 'index.db')
+    process(start())
+    settings.autoCorrectFilename = not settings.autoCorrectFilename
+    assert len(process(start())) == 40
+
+
+def test_signature_is_stored_once(workspace, start):
+    settings = workspace[0]
+    settings.scanIndex = os.path.join(settings.logPath, 'index.db')
+    process(start())
+    bot = start()
+    with bot.scan():
+        signature = bot.files_signature()
+    row = bot.index.query("SELECT value FROM params WHERE name='files'", ())
+    assert row[0] == signature
+    assert bot.index.query("SELECT count(*) FROM files", ())[0] == 40
@@ -0,0 +1,98 @@
+import shutil
+from datetime import datetime
+
+import pytest
+from mutagen.easyid3 import EasyID3
+from mutagen.id3 import ID3
+from mutagen.mp3 import MP3
+
+import botools
+import bench_suite
+from botools import IOScheduler, TokenBucket, TagsModel, BTException, SOURCE, IO_MIN_CHUNK_SIZE
+
+
+def test_parse_hours():
+    assert IOScheduler.parse_hours(['06:00-13:00', ' 22:00-02:00 ', '']) == [(360, 780), (1320, 120)]
+
+
+@pytest.mark.parametrize('value', ['25:00-01:00', '06:60-07:00', '6h-7h'])
+def test_parse_hours_rejects_bad_ranges(value):
+    with pytest.raises(BTException):
+        IOScheduler.parse_hours([value])
+
+
+def test_is_on_air_across_midnight():
+    scheduler = IOScheduler(on_air_hours=IOScheduler.parse_hours(['06:00-13:00', '22:00-02:00']))
+    on_air = [hour for hour in range(24) if scheduler.is_on_air(datetime(2024, 1, 1, hour, 30))]
+    assert on_air == [0, 1, 6, 7, 8, 9, 10, 11, 12, 22, 23]
+
+
+def test_scheduler_without_limits_never_waits():
+    scheduler = IOScheduler()
+    assert not scheduler.enabled
+    assert scheduler.chunk_size() is None
+    assert scheduler.backlog() == 0.0
+
+
+def test_token_bucket_debt():
+    bucket = TokenBucket(100)
+    assert bucket.take(50) == 0.0
+    assert bucket.take(150) == pytest.approx(1.0, abs=0.05)
+    assert bucket.debt() == pytest.approx(1.0, abs=0.05)
+
+
+def test_token_bucket_without_rate():
+    bucket = TokenBucket(0)
+    assert bucket.take(10 ** 9) == 0.0
+    assert bucket.debt() == 0.0
+
+
+class RecordingScheduler(IOScheduler):
+    """ limiteur à débit élevé (pas d'attente) qui enregistre les octets demandés """
+
+    def __init__(self, rate):
+        super().__init__({True : (rate, 0), False : (rate, 0)})
+        self.sizes = []
+
+    def acquire(self, size=0, ops=1):
+        self.sizes.append(size)
+        super().acquire(size, ops)
+
+
+@pytest.fixture
+def tagged_file(tmp_path, workspace, engine):
+    """ mp3 avec tags ID3v2 et ID3v1 et un contenu audio de plusieurs blocs de copie """
+    full_pathname = str(tmp_path / 'tagged.mp3')
+    with open(full_pathname, 'wb') as target:
+        target.write(bench_suite.make_mp3('Jazz', 2020, 3, 'Episode 1') + bytes(range(256)) * 1024)
+    ID3(full_pathname).save(full_pathname, v1=2)
+    return full_pathname
+
+
+def test_rewrite_tags_streams_audio_through_limiter(tagged_file, tmp_path, workspace, engine):
+    settings = workspace[0]
+    engine.io = RecordingScheduler(IO_MIN_CHUNK_SIZE * 4)
+    tags = TagsModel(SOURCE)
+    tags.fileTags = MP3(tagged_file, ID3=EasyID3)
+    tags.fileTags['title'] = 'Un titre bien plus long ' * 40
+    # référence : réécriture complète du fichier par mutagen
+    expected = str(tmp_path / 'expected.mp3')
+    shutil.copy(tagged_file, expected)
+    tags.fileTags.save(expected, padding=lambda info : settings.tagPadding)
+
+    tags.rewriteTags(tagged_file)
+    assert open(tagged_file, 'rb').read() == open(expected, 'rb').read()
+    chunk = engine.io.chunk_size()
+    audio_sizes = [size for size in engine.io.sizes if size > settings.tagPadding]
+    assert len(audio_sizes) > 1
+    assert max(engine.io.sizes) <= chunk
+
+
+def test_in_place_save_goes_through_limiter(tagged_file, workspace, engine, monkeypatch):
+    monkeypatch.setattr(botools, 'SAVE_FILE_KEYS', [botools.ARTIST, botools.YEAR])
+    engine.io = RecordingScheduler(IO_MIN_CHUNK_SIZE * 4)
+    tags = TagsModel(SOURCE)
+    tags.fileTags = MP3(tagged_file, ID3=EasyID3)
+    tags.calcTags = {key : tags.getFileTag(key) for key in botools.SAVE_FILE_KEYS}
+    tags.save()
+    assert engine.io.sizes == [botools.file_tag_size(tagged_file)]
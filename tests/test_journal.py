@@ -0,0 +1,54 @@
+import json
+import os
+
+from botools import Journal, JOURNAL_POS, JOURNAL_VERSION, JOURNAL_COPY, STEP_COPIED, RELPATH, FILENAME
+
+
+def write_journal(path, events):
+    with open(path, 'w', encoding='utf-8') as target:
+        for event in events:
+            target.write(json.dumps(event, ensure_ascii=False) + '\n')
+
+
+def test_replay_keeps_unfinished_files(archive, tmp_path):
+    bot, settings, programmes, sync_log = archive
+    files = [{RELPATH : '2020/A/', FILENAME : f'A#2020#0{i}#x.mp3', JOURNAL_POS : i} for i in range(3)]
+    path = str(tmp_path / 'journal.jsonl')
+    write_journal(path, [{'journal' : JOURNAL_VERSION, 'params' : Journal.params()}, {'files' : files}, {'done' : 1}])
+    with open(path, 'a', encoding='utf-8') as target:
+        # arrêt pendant l'écriture de la dernière ligne
+        target.write('{"done" : ')
+    journal = Journal(path)
+    journal.open()
+    assert [file_id[JOURNAL_POS] for file_id in journal.pending()] == [0, 2]
+    assert journal.next_position == 3
+    journal.close()
+    assert os.path.exists(path)
+
+
+def test_replay_repairs_interrupted_copy(archive, tmp_path):
+    bot, settings, programmes, sync_log = archive
+    partial = settings.root['local'] + 'current/partielle.mp3'
+    os.makedirs(os.path.dirname(partial), exist_ok=True)
+    open(partial, 'wb').close()
+    path = str(tmp_path / 'journal.jsonl')
+    step = {'step' : [0, 1], 'op' : JOURNAL_COPY, 'from' : '2020/A/a.mp3', 'to' : 'current/partielle.mp3', 'state' : STEP_COPIED}
+    write_journal(path, [{'journal' : JOURNAL_VERSION, 'params' : Journal.params()}, step])
+    journal = Journal(path)
+    journal.open()
+    assert not os.path.exists(partial)
+    assert not journal.steps
+    journal.close()
+    # plus rien à reprendre : le journal est supprimé
+    assert not os.path.exists(path)
+
+
+def test_journal_with_other_params_is_ignored(archive, tmp_path):
+    bot, settings, programmes, sync_log = archive
+    path = str(tmp_path / 'journal.jsonl')
+    params = dict(Journal.params(), scanPathFilter=['autre'])
+    write_journal(path, [{'journal' : JOURNAL_VERSION, 'params' : params}, {'files' : [{JOURNAL_POS : 0}]}])
+    journal = Journal(path)
+    journal.open()
+    assert not journal.files
+    journal.close()
@@ -0,0 +1,50 @@
+import os
+
+from botools import Engine, LOG_PARTIAL_EXT, LOG_INTERRUPTED, LOG_WARNING, LOG_INFO, LOG_DETAIL
+
+
+def partial_logs(settings):
+    return sorted(name for name in os.listdir(settings.logPath) if name.endswith(LOG_PARTIAL_EXT))
+
+
+def test_interrupted_log_is_recovered(workspace, start):
+    settings = workspace[0]
+    os.makedirs(settings.logPath, exist_ok=True)
+    stale = settings.logPath + settings.logMask + '_2020-01-01_00-00-00' + LOG_PARTIAL_EXT
+    with open(stale, 'w', encoding='utf-8') as target:
+        target.write('arrêt brutal\n')
+    start()
+    assert os.path.exists(stale[:-len(LOG_PARTIAL_EXT)] + LOG_INTERRUPTED + '.log')
+    assert not os.path.exists(stale)
+
+
+def test_log_in_progress_is_left_alone(archive):
+    bot, settings, programmes, sync_log = archive
+    running = partial_logs(settings)
+    assert running
+    Engine(-1, 0).recover_partial(settings.logPath, settings.logMask)
+    assert partial_logs(settings) == running
+
+def test_messages_before_start_are_kept(workspace):
+    settings = workspace[0]
+    bot = Engine(-1, 0)
+    bot.info('message antérieur au démarrage')
+    bot.start(settings)
+    log_filename = bot.log_filename
+    bot.close()
+    with open(bot.log_filename, encoding='utf-8') as source:
+        assert 'message antérieur au démarrage' in source.read()
+    assert log_filename in bot.log_filename
+
+
+def test_enabled_follows_send(workspace, engine):
+    settings = workspace[0]
+    messages = []
+    # avant start() tous les messages sont conservés
+    assert engine.enabled(LOG_DETAIL)
+    settings.logScreenLevel, settings.logFileLevel = LOG_INFO, 0
+    engine.start(settings)
+    assert engine.enabled(LOG_INFO) and engine.enabled(LOG_WARNING)
+    assert not engine.enabled(LOG_DETAIL)
+    engine.detail(lambda : messages.append('construit') or 'message')
+    assert not messages
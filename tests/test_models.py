@@ -0,0 +1,19 @@
+from botools import slot_model, base_model, short_model, PHY_MODELS, TITLE_SUM_KEYS, CALC_FILENAME
+
+
+def test_slot_model():
+    assert [slot_model(rank) for rank in range(4)] == ['current', 'previous', 'previous2', 'previous3']
+
+
+def test_slot_model_leaves_tables_unchanged():
+    tables = [dict(PHY_MODELS), dict(TITLE_SUM_KEYS), dict(CALC_FILENAME)]
+    slot_model(5)
+    assert [PHY_MODELS, TITLE_SUM_KEYS, CALC_FILENAME] == tables
+
+
+def test_extra_slots_follow_previous():
+    assert base_model('previous4') == 'previous'
+    assert base_model('current') == 'current'
+    assert short_model('previous4') == 'P4#'
+    assert short_model('previous') == 'P#'
+    assert short_model('current') == 'C#'
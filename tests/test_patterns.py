@@ -0,0 +1,56 @@
+from types import SimpleNamespace
+
+import pytest
+
+import bench_suite
+from botools import PatternSet, TagsModel, CURRENT, RAW_TITLE
+
+AUDIO_SIGNATURE = r'([^#]+)#(\d{1,4})#(\d{1,4})#?(.*)\.(mp3)$'
+ACTION_LINES = [[r'(création du fichier).*"(.*)"'], [r'(mise à jour du fichier).*"(.*)"'],
+                [r'(déplacement du fichier)(?!.*corbeille)', '(.*)', '(vers)', r'(")(.*)"']]
+
+
+def make_patterns():
+    root = {'local': 'D:/Antenne/Emissions/', 'distant': 'L:/Emissions/'}
+    return PatternSet(SimpleNamespace(audioSignature=AUDIO_SIGNATURE, root=root, syncActionLine=ACTION_LINES))
+
+
+def test_audio_signature():
+    patterns = make_patterns()
+    assert patterns.audio.findall('Jazz à Gogo#2023#07#Episode 3.MP3') == [('Jazz à Gogo', '2023', '07', 'Episode 3', 'MP3')]
+    assert patterns.audio.findall('Jazz à Gogo - 2023 - 07.mp3') == []
+
+
+def test_root_is_case_insensitive():
+    match = make_patterns().root.search('d:/antenne/emissions/2023/Jazz/')
+    assert match.group(2) == '2023/Jazz/'
+    assert make_patterns().root.search('E:/Autre/2023/') is None
+
+
+def test_action_heads_name_each_action():
+    text = ('[10:00:00] Info: Création du fichier "D:/Antenne/Emissions/a.mp3"\n'
+            '[10:00:01] Info: Déplacement du fichier\n'
+            '[10:00:02] Info: Déplacement du fichier vers la corbeille\n')
+    hits = [hit.lastgroup for hit in make_patterns().action_heads.finditer(text)]
+    assert hits == ['action0', 'action2']
+
+
+def test_title_part_is_cached():
+    first = PatternSet.title_part('2023')
+    assert PatternSet.title_part('2023') is first
+    assert first.sub('', 'C# 2023 -Episode') == 'C#Episode'
+
+
+def test_title_part_ignores_case():
+    assert PatternSet.title_part('c#').sub('', 'C#-Episode', count=1) == 'Episode'
+
+
+@pytest.mark.parametrize('title', ['2011-29-(%s)-Episode 129', 'C#-2011-29-(%s)-Episode 129'])
+def test_raw_title_keeps_tag_values_inside_title(tmp_path, workspace, engine, title):
+    # seule la première occurrence de chaque valeur est retirée du titre
+    full_pathname = str(tmp_path / 'Jazz#2011#29#Episode 129.mp3')
+    with open(full_pathname, 'wb') as target:
+        target.write(bench_suite.make_mp3('Jazz', 2011, 29, title % bench_suite.LENGTH))
+    tags = TagsModel(CURRENT, calc_tags={})
+    tags.loadSet(full_pathname)
+    assert tags.calcTags[RAW_TITLE] == 'Episode 129'
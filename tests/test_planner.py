@@ -0,0 +1,57 @@
+from collections import Counter
+
+from conftest import titles
+from botools import AudioFile, cp_id, ARTIST, YEAR, TRACK, RAW_TITLE, RELPATH, FILENAME, CP_BATCH, CP_SLOTS
+
+
+def make_file(artist, track, process_cp=True, **extra):
+    return dict({ARTIST : artist, YEAR : '2020', TRACK : str(track), RAW_TITLE : f'Episode {track}',
+                 RELPATH : f'2020/{artist}/', FILENAME : f'{artist}#2020#{track:02d}#Episode {track}.mp3',
+                 'processCP' : process_cp}, **extra)
+
+
+def test_plan_keeps_newest_episodes(workspace, engine):
+    files = [make_file('Jazz', 2), make_file('Jazz', 3), make_file('Blues', 1), make_file('Jazz', 1),
+             make_file('Rock', 9, process_cp=False)]
+    planned = engine.plan_cp(files)
+    # les retenus d'un artiste sont traités du plus récent au plus ancien, aux positions de l'artiste dans le lot
+    assert [file_id[FILENAME] for file_id in planned] == [files[position][FILENAME] for position in (1, 0, 2, 3, 4)]
+    assert [file_id['processCP'] for file_id in planned] == [True, True, True, False, False]
+    # le plus récent réserve l'emplacement du suivant
+    assert planned[0][CP_BATCH] == [cp_id(files[0])]
+    assert CP_BATCH not in planned[1] and CP_BATCH not in planned[2]
+    assert CP_BATCH not in files[1] and files[3]['processCP']
+
+
+def test_plan_follows_slot_count(workspace, engine):
+    files = [make_file('Jazz', track, **{CP_SLOTS : 3}) for track in (1, 2, 3)]
+    planned = engine.plan_cp(files)
+    assert all(file_id['processCP'] for file_id in planned)
+    assert planned[0][CP_BATCH] == [cp_id(files[1]), cp_id(files[0])]
+
+
+def test_each_slot_written_once(reference, archive, monkeypatch):
+    bot, settings, programmes, sync_log = archive
+    writes = Counter()
+    moves = []
+    copy_slot, move_audio = AudioFile.copy_slot, AudioFile.move_audio
+
+    def counted_copy_slot(audio, model, source_id, holes):
+        writes[(audio.get_tag(ARTIST, calc=True), model)] += 1
+        return copy_slot(audio, model, source_id, holes)
+
+    def counted_move_audio(audio, model, new_model):
+        if model != new_model:
+            moves.append((model, new_model))
+        return move_audio(audio, model, new_model)
+
+    monkeypatch.setattr(AudioFile, 'copy_slot', counted_copy_slot)
+    monkeypatch.setattr(AudioFile, 'move_audio', counted_move_audio)
+    with bot.scan() as files:
+        # du plus ancien au plus récent : sans planification chaque épisode décalerait les précédents
+        for file_id in bot.plan_cp(list(reversed(files))):
+            bot.manageAudioSet(file_id)
+    bot.close()
+    assert writes and max(writes.values()) == 1
+    assert not moves
+    assert (titles(settings), titles(settings, 'distant')) == reference[:2]
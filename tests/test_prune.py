@@ -0,0 +1,47 @@
+import os
+import shutil
+
+from conftest import process
+from botools import DirScan, RELPATH, FILENAME
+
+
+def prune(settings):
+    settings.scanIndex = os.path.join(settings.logPath, 'index.db')
+    settings.scanPruneDirs = True
+
+
+def test_unchanged_directories_are_not_listed(workspace, start):
+    settings = workspace[0]
+    prune(settings)
+    process(start())
+    bot = start()
+    with bot.scan() as files:
+        assert not files
+    assert bot.index.query("SELECT count(*) FROM dirs", ())[0] > 0
+
+
+def test_added_file_is_found_when_mtime_is_unchanged(workspace, start):
+    """ partage réseau dont la date de modification ne suit pas l'ajout d'un fichier : le nombre d'entrées le révèle """
+    settings = workspace[0]
+    prune(settings)
+    first = process(start())[0]
+    directory = settings.root['local'] + first[RELPATH]
+    stat = os.stat(directory)
+    artist, year, track, title = first[FILENAME][:-4].split('#')
+    added = f'{artist}#{year}#{track}#Episode ajouté.mp3'
+    shutil.copy(directory + first[FILENAME], directory + added)
+    os.utime(directory, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert [file_id[FILENAME] for file_id in process(start())] == [added]
+
+
+def test_stop_point_in_root_directory(archive):
+    """ la racine se termine par '/' : ses fichiers non traités à l'arrêt du mode flux la laissent non parcourue """
+    bot, settings, programmes, sync_log = archive
+    scan = DirScan()
+    top = settings.root['local']
+    sub = os.path.join(top, '2020')
+    scan.traversed = {top, sub}
+    scan.stopped_at([{RELPATH : '', FILENAME : 'a.mp3'}])
+    assert scan.traversed == {sub}
+    scan.stopped_at([{RELPATH : '2020/', FILENAME : 'b.mp3'}])
+    assert scan.traversed == set()
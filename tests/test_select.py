@@ -0,0 +1,42 @@
+import botools
+from botools import DirScan, NORM_FILNAME
+
+
+def names(files):
+    return [file_id[NORM_FILNAME] for file_id in files]
+
+
+def test_selection_batches_follow_full_order(archive):
+    bot, settings, programmes, sync_log = archive
+    with DirScan() as files:
+        full = names(files)
+    batches = []
+    with DirScan(select_limit=5) as files:
+        while files:
+            batches.append(names(files))
+            files = files.more()
+    # chaque lot suivant est deux fois plus grand et reprend où le précédent s'est arrêté
+    assert [len(batch) for batch in batches[:3]] == [5, 10, 20]
+    assert sum(batches, []) == full
+
+
+def test_change_limit_processes_newest_first(workspace, start, monkeypatch):
+    settings = workspace[0]
+    monkeypatch.setattr(botools, 'SELECT_MIN', 1)
+    settings.changeLimit = 2
+    bot = start()
+    with DirScan() as files:
+        full = names(files)
+    processed = []
+    with bot.scan() as files:
+        assert len(files) == settings.changeLimit * botools.SELECT_MARGIN
+        while files and not bot.limit_reached():
+            for file_id in bot.plan_cp(files):
+                bot.manageAudioSet(file_id)
+                processed.append(file_id[NORM_FILNAME])
+                if bot.limit_reached():
+                    break
+            files = files.more()
+    bot.close()
+    assert bot.change_count == 2
+    assert processed == full[:len(processed)]
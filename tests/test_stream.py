@@ -0,0 +1,45 @@
+import threading
+
+from conftest import titles
+from botools import NORM_FILNAME
+
+
+def streamed_order(bot):
+    with bot.scan() as files:
+        order = [file_id[NORM_FILNAME] for file_id in files]
+    bot.close()
+    return order
+
+
+def test_stream_matches_sequential(reference, workspace, start):
+    settings = workspace[0]
+    settings.scanStream = True
+    bot = start()
+    with bot.scan() as files:
+        assert bot.manageAudioStream(files) == 40
+    bot.close()
+    assert (titles(settings), titles(settings, 'distant'), bot.change_count) == reference
+
+
+def test_stream_window_orders_newest_first(workspace, start):
+    settings = workspace[0]
+    settings.scanStream = True
+    settings.streamWindow = 0
+    walked = streamed_order(start())
+    settings.streamWindow = 200
+    ordered = streamed_order(start())
+    assert len(walked) == 40
+    assert walked != ordered
+    assert ordered == sorted(walked, reverse=True)
+
+
+def test_stream_stops_on_change_limit(workspace, start):
+    settings = workspace[0]
+    settings.scanStream = True
+    settings.changeLimit = 2
+    bot = start()
+    with bot.scan() as files:
+        assert bot.manageAudioStream(files) is None
+    bot.close()
+    assert bot.change_count == 2
+    assert not [thread for thread in threading.enumerate() if thread.name == 'scan']
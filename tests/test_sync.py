@@ -0,0 +1,34 @@
+import os
+
+from botools import FileScan, SyncCursor
+
+
+def test_line_offset_counts_raw_bytes():
+    data = 'é\r\nà\r\n'.encode('utf-8') + b'\xff\r\nfin\r\n'
+    assert [FileScan.line_offset(data, line) for line in range(4)] == [0, 4, 8, 11]
+
+
+def test_resume_offset_after_incomplete_move(archive):
+    bot, settings, programmes, sync_log = archive
+    sync_dir = settings.syncPath
+    lines = open(sync_log, encoding='utf-8').read().splitlines()
+    os.remove(sync_log)
+    move = next(position for position, line in enumerate(lines) if 'Déplacement' in line)
+    # octets invalides et fins de ligne Windows : le texte décodé n'a plus la longueur des octets lus
+    head = b'x \xff\xff illisible\r\n' + '\r\n'.join(lines[:move + 2]).encode('utf-8') + b'\r\n'
+    log = os.path.join(sync_dir, 'rb_audio 1.log')
+    with open(log, 'wb') as target:
+        target.write(head)
+    cursor = SyncCursor(os.path.join(settings.logPath, 'cursor.json'))
+    FileScan(sync_dir, cursor).readLines()
+    offset = cursor.offsets['rb_audio 1.log']
+    # la lecture reprendra au début du déplacement incomplet
+    assert head[offset:].startswith(lines[move].encode('utf-8'))
+
+    with open(log, 'ab') as target:
+        target.write('\r\n'.join(lines[move + 2:]).encode('utf-8') + b'\r\n')
+    cursor.save()
+    resumed = FileScan(sync_dir, SyncCursor(cursor.path))
+    resumed.readLines()
+    moved = [file_id for file_id in resumed.files if lines[move + 3].strip('"').endswith(file_id['filename'])]
+    assert moved
@@ -0,0 +1,57 @@
+import threading
+import time
+from collections import Counter
+
+from conftest import titles
+from botools import Engine, ARTIST
+
+
+def run_batch(bot, workers):
+    with bot.scan() as files:
+        completed = bot.manageAudioBatch(bot.plan_cp(files), workers)
+    bot.close()
+    return completed
+
+
+def test_workers_match_sequential(reference, workspace, start):
+    settings = workspace[0]
+    settings.workers = 4
+    bot = start()
+    assert run_batch(bot, 4)
+    assert (titles(settings), titles(settings, 'distant'), bot.change_count) == reference
+
+
+def test_artist_files_are_serialized(workspace, start, monkeypatch):
+    running = Counter()
+    peaks = Counter()
+    lock = threading.Lock()
+    manage_audio_set = Engine.manageAudioSet
+
+    def tracked(bot, file_id):
+        artist = file_id[ARTIST]
+        with lock:
+            running[artist] += 1
+            running['*'] += 1
+            peaks[artist] = max(peaks[artist], running[artist])
+            peaks['*'] = max(peaks['*'], running['*'])
+        try:
+            # laisse aux autres threads le temps de démarrer
+            time.sleep(0.01)
+            return manage_audio_set(bot, file_id)
+        finally:
+            with lock:
+                running[artist] -= 1
+                running['*'] -= 1
+
+    monkeypatch.setattr(Engine, 'manageAudioSet', tracked)
+    assert run_batch(start(), 4)
+    assert peaks.pop('*') > 1
+    assert max(peaks.values()) == 1
+
+
+def test_change_limit_with_workers(workspace, start):
+    settings = workspace[0]
+    settings.changeLimit = 3
+    bot = start()
+    assert not run_batch(bot, 4)
+    assert bot.change_count == 3